@@ -1,21 +1,69 @@
+import asyncio
+import contextlib
 import logging
 
 import uvicorn as uvicorn
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, HTTPException, UploadFile
+from sqlalchemy import delete, inspect, text
 from sqlalchemy.orm import Session
 from starlette import status
 
 import controller
 import exceptions
 import models
+import profiling
+import write_behind
+from config import params
 from database import engine, get_db
 
 logging.basicConfig()
 logging.getLogger().setLevel(logging.INFO)
 
-models.Base.metadata.create_all(bind=engine)
+# arbitrary key of the advisory lock serializing init_db between workers
+_INIT_DB_LOCK = 0x616D70
 
-app = FastAPI()
+
+def init_db() -> None:
+    """
+    Create missing tables and upgrade existing ones. Every worker process runs it at
+    startup, so concurrent runs are serialized with a Postgres advisory lock.
+    """
+    with engine.begin() as connection:
+        connection.execute(
+            text("SELECT pg_advisory_xact_lock(:key)"), {"key": _INIT_DB_LOCK}
+        )
+        tables = inspect(connection).get_table_names()
+        models.Base.metadata.create_all(bind=connection)
+        # create_all does not add columns to existing tables
+        connection.execute(
+            text(
+                "ALTER TABLE vehicles ADD COLUMN IF NOT EXISTS source_hash varchar(64)"
+            )
+        )
+        if "import_manifests" in tables and "import_manifest_vehicles" not in tables:
+            # manifests recorded before their plates were, would never park a removed vehicle
+            connection.execute(delete(models.ImportManifest))
+
+
+init_db()
+
+
+@contextlib.asynccontextmanager
+async def lifespan(_: FastAPI):
+    flusher = None
+    if write_behind.enabled():
+        flusher = asyncio.create_task(write_behind.run_flusher())
+    yield
+    if flusher is not None:
+        flusher.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await flusher
+
+
+app = FastAPI(lifespan=lifespan)
+if params.PROFILING:
+    # an HTTP middleware wraps every request, only install it when profiling is wanted
+    app.middleware("http")(profiling.profile_request)
 
 
 @app.get("/data", response_model=models.GetDataResponse)
@@ -23,8 +71,7 @@ async def get_data(*, session: Session = Depends(get_db)):
     """
     Retrieve all plates that have reached the desired charge.
     """
-    vehicles_ready = controller.update_and_retrieve_ready(session)
-    return models.GetDataResponse(ready=[vehicle.plate for vehicle in vehicles_ready])
+    return models.GetDataResponse(ready=controller.update_and_retrieve_ready(session))
 
 
 @app.post(
@@ -32,16 +79,53 @@ async def get_data(*, session: Session = Depends(get_db)):
 )
 async def post_data(data: models.PostDataBody, session: Session = Depends(get_db)):
     """
-    Import data from a CSV or TXT direct url.
-    The file should be in the following format (no header):
+    Import data from a direct url.
+    The file should contain the following fields (no header for CSV):
     plate (str),current_charge (int: Ah,total_charge (int: Ah),desired_charge (int: %),
+    Supported formats are CSV, NDJSON, Arrow IPC and Parquet (the last two require pyarrow).
+    With bulk=true rows are loaded through Postgres COPY, which is much faster for new datasets.
+    Imports are idempotent: files already imported and rows matching the stored state
+    are skipped and reported in the skipped counter.
+    """
+    try:
+        imported, skipped = await controller.import_data(
+            data.url, session, data.data_format, data.bulk
+        )
+    except (exceptions.UnsupportedFormatError, exceptions.InvalidFileError) as ex:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(ex))
+    if not imported and not skipped:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=f"Could not import articles"
+        )
+    return models.PostDataResponse(imported=imported, skipped=skipped)
+
+
+@app.post(
+    "/data/upload",
+    status_code=status.HTTP_201_CREATED,
+    response_model=models.PostDataResponse,
+)
+async def upload_data(
+    file: UploadFile,
+    data_format: models.DataFormat = models.DataFormat.CSV,
+    bulk: bool = False,
+    session: Session = Depends(get_db),
+):
     """
-    imported = await controller.import_data(data.url, session)
-    if not imported:
+    Import data from an uploaded file (multipart/form-data).
+    The accepted formats and fields are the same as POST /data.
+    """
+    try:
+        imported, skipped = await controller.import_upload(
+            file.file, session, data_format, bulk
+        )
+    except (exceptions.UnsupportedFormatError, exceptions.InvalidFileError) as ex:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(ex))
+    if not imported and not skipped:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail=f"Could not import articles"
         )
-    return models.PostDataResponse(imported=imported)
+    return models.PostDataResponse(imported=imported, skipped=skipped)
 
 
 @app.get("/vehicle/{plate}", response_model=models.GetVehicleResponse)
@@ -72,5 +156,24 @@ def delete_vehicle(plate: str, session: Session = Depends(get_db)):
     return models.DeleteVehicleResponse(current_charge=current_charge)
 
 
+@app.get("/status/write-behind", response_model=models.WriteBehindStatusResponse)
+def get_write_behind_status():
+    """
+    Retrieve the number of charge state changes not yet written to the DB
+    and the age in seconds of the oldest one
+    """
+    return write_behind.status()
+
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=5000, log_level="info")
+    # the workers import the app on their own, the supervisor must not keep a connection
+    engine.dispose()
+    uvicorn.run(
+        "app:app",
+        host=params.HOST,
+        port=params.PORT,
+        workers=params.WORKERS,
+        limit_max_requests=params.WORKER_MAX_REQUESTS or None,
+        timeout_graceful_shutdown=params.GRACEFUL_TIMEOUT,
+        log_level="info",
+    )
@@ -25,6 +25,31 @@ class Params:
         self.DB_NAME = config.get_param(f"DB_NAME")
         self.DB_ENDPOINT = config.get_param("DB_ENDPOINT")
         self.REDIS_ENDPOINT = config.get_param("REDIS_ENDPOINT")
+        self.DB_MAX_CONNECTIONS = int(config.get_param("DB_MAX_CONNECTIONS") or 90)
+        self.HOST = config.get_param("HOST") or "0.0.0.0"
+        self.PORT = int(config.get_param("PORT") or 5000)
+        self.WORKERS = int(config.get_param("WORKERS") or 1)
+        self.WORKER_MAX_REQUESTS = int(config.get_param("WORKER_MAX_REQUESTS") or 0)
+        self.WORKER_MAX_REQUESTS_JITTER = int(
+            config.get_param("WORKER_MAX_REQUESTS_JITTER") or 0
+        )
+        self.GRACEFUL_TIMEOUT = int(config.get_param("GRACEFUL_TIMEOUT") or 30)
+        self.IMPORT_CHUNK_SIZE = int(config.get_param("IMPORT_CHUNK_SIZE") or 500)
+        self.WRITE_BEHIND = config.get_param("WRITE_BEHIND")
+        self.WRITE_BEHIND_INTERVAL = float(
+            config.get_param("WRITE_BEHIND_INTERVAL") or 1.0
+        )
+        self.WRITE_BEHIND_BATCH_SIZE = int(
+            config.get_param("WRITE_BEHIND_BATCH_SIZE") or 100
+        )
+        self.IMPORT_LOG_INTERVAL = float(config.get_param("IMPORT_LOG_INTERVAL") or 5.0)
+        self.PROFILING = (config.get_param("PROFILING") or "").lower() in (
+            "1",
+            "true",
+            "yes",
+        )
+        self.PROFILE_SAMPLE_RATE = float(config.get_param("PROFILE_SAMPLE_RATE") or 0)
+        self.PROFILE_DIR = config.get_param("PROFILE_DIR")
 
 
 params = Params(EnvConfig())
@@ -1,80 +1,416 @@
+import csv
+import codecs
 import datetime
+import hashlib
+import io
+import json
 import logging
+import shutil
+import tempfile
 import typing
 
 import httpx
 import pytz
-from sqlalchemy import select
+from sqlalchemy import exists, select, text
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import Session
 
 import models
+import parsers
 import redis_api
-from exceptions import VehicleDoesNotExistError
+import write_behind
+from config import params
+from import_log import ImportLog
+from exceptions import InvalidFileError, VehicleDoesNotExistError
 
+_HASH_BLOCK_SIZE = 1 << 16
 
-async def import_data(url: str, session: Session) -> int:
+_VEHICLE_STATE_FIELDS = (
+    "current_charge",
+    "total_charge",
+    "desired_percentage",
+    "start_time",
+    "parked",
+    "source_hash",
+)
+
+
+_CREATE_STAGING_SQL = """
+DROP TABLE IF EXISTS vehicles_staging;
+CREATE TEMPORARY TABLE vehicles_staging (
+    line serial,
+    plate text,
+    current_charge integer,
+    total_charge integer,
+    desired_percentage integer,
+    source_hash text
+) ON COMMIT DROP
+"""
+
+_COPY_STAGING_SQL = """
+COPY vehicles_staging (plate, current_charge, total_charge, desired_percentage, source_hash)
+FROM STDIN WITH (FORMAT csv)
+"""
+
+_MERGE_STAGING_SQL = """
+INSERT INTO vehicles
+    (plate, current_charge, total_charge, desired_percentage, start_time, parked, source_hash)
+SELECT DISTINCT ON (plate)
+    plate, current_charge, total_charge, desired_percentage, :start_time, true, source_hash
+FROM vehicles_staging
+ORDER BY plate, line DESC
+ON CONFLICT (plate) DO UPDATE SET
+    current_charge = EXCLUDED.current_charge,
+    total_charge = EXCLUDED.total_charge,
+    desired_percentage = EXCLUDED.desired_percentage,
+    start_time = EXCLUDED.start_time,
+    parked = EXCLUDED.parked,
+    source_hash = EXCLUDED.source_hash
+WHERE NOT vehicles.parked OR vehicles.source_hash IS DISTINCT FROM EXCLUDED.source_hash
+RETURNING plate, current_charge, total_charge, desired_percentage
+"""
+
+_RECORD_STAGED_PLATES_SQL = """
+INSERT INTO import_manifest_vehicles (manifest_hash, plate)
+SELECT DISTINCT :manifest_hash, plate FROM vehicles_staging
+ON CONFLICT DO NOTHING
+"""
+
+
+async def import_data(
+    url: str,
+    session: Session,
+    data_format: models.DataFormat = models.DataFormat.CSV,
+    bulk: bool = False,
+) -> tuple[int, int]:
+    """
+    Import data from a URL.
+    The source is downloaded to a temporary file first, so that its content hash is known
+    before any row is applied.
+    :param url: direct link to a file without header
+    :param session: db session
+    :param data_format: format of the file
+    :param bulk: load rows through a Postgres COPY into a staging table instead of the ORM
+    :return: imported vehicles, vehicles skipped because already up to date
+    """
+    with tempfile.TemporaryFile() as buffer:
+        await _stream_data(url, buffer)
+        buffer.seek(0)
+        return await import_file(buffer, session, data_format, bulk)
+
+
+async def import_upload(
+    upload: typing.BinaryIO,
+    session: Session,
+    data_format: models.DataFormat = models.DataFormat.CSV,
+    bulk: bool = False,
+) -> tuple[int, int]:
+    """
+    Import data from an uploaded file.
+    The upload is copied to a temporary file first, as the spooled file of an upload
+    does not implement the whole io interface on Python 3.10 (e.g. readable()).
+    :param upload: binary file object of the upload, without header
+    :param session: db session
+    :param data_format: format of the file
+    :param bulk: load rows through a Postgres COPY into a staging table instead of the ORM
+    :return: imported vehicles, vehicles skipped because already up to date
+    """
+    with tempfile.TemporaryFile() as buffer:
+        shutil.copyfileobj(upload, buffer)
+        buffer.seek(0)
+        return await import_file(buffer, session, data_format, bulk)
+
+
+async def import_file(
+    file: typing.BinaryIO,
+    session: Session,
+    data_format: models.DataFormat = models.DataFormat.CSV,
+    bulk: bool = False,
+) -> tuple[int, int]:
+    """
+    Import data from a file.
+    Files whose content was already fully imported are skipped, as well as chunks of rows
+    already applied by a previous, interrupted, import of the same file and rows that
+    match the stored state of a parked vehicle.
+    A file is imported again if one of its vehicles was removed since, to park it again.
+    Raises InvalidFileError if the file cannot be read in the given format.
+    :param file: seekable binary file object without header
+    :param session: db session
+    :param data_format: format of the file
+    :param bulk: load rows through a Postgres COPY into a staging table instead of the ORM
+    :return: imported vehicles, vehicles skipped because already up to date
+    """
+    # unchanged rows are detected against the stored state, which must be current
+    await write_behind.drain(session)
+    manifest_hash = _hash_file(file, data_format)
+    manifest, removed = _get_manifest(manifest_hash, session)
+    resume = manifest is not None and not removed
+    if resume and manifest.completed:
+        logging.info(f"Manifest {manifest_hash} already imported, skipping")
+        return 0, manifest.rows
+
+    log = ImportLog(f"{data_format.value}:{manifest_hash[:12]}")
+    # opened before the manifest is recorded, unreadable files raise here
+    records = _iter_records(file, data_format, log)
+    if manifest is None:
+        # an overlapping import of the same file may have recorded it in the meantime
+        session.execute(
+            insert(models.ImportManifest)
+            .values(content_hash=manifest_hash, data_format=data_format.value)
+            .on_conflict_do_nothing()
+        )
+        session.commit()
+        manifest = session.get(models.ImportManifest, manifest_hash)
+    elif not resume:
+        logging.info(f"Manifest {manifest_hash} has removed vehicles, importing again")
+
+    if bulk:
+        _copy_and_merge(records, manifest_hash, session, log)
+    else:
+        for chunk in _iter_chunks(records, params.IMPORT_CHUNK_SIZE):
+            _import_chunk(chunk, manifest_hash, resume, session, log)
+    log.done()
+
+    imported, skipped = log.imported, log.skipped
+    if imported or skipped:
+        manifest.rows = imported + skipped
+        manifest.completed = True
+        session.commit()
+    return imported, skipped
+
+
+def _import_chunk(
+    chunk: list[dict],
+    manifest_hash: str,
+    resume: bool,
+    session: Session,
+    log: ImportLog,
+) -> None:
     """
-    Import data from a URL
-    :param url: direct link to a CSV file without header
+    Apply a chunk of records through the ORM in a single transaction.
+    :param chunk: records
+    :param manifest_hash: content hash of the file the chunk belongs to
+    :param resume: skip the chunk if it was already applied
     :param session: db session
-    :return: imported vehicles
+    :param log: import log, updated with the outcome of the chunk
+    :return: None
     """
-    count = 0
+    chunk_hash = _hash_records(chunk)
+    applied = session.get(models.ImportChunk, (manifest_hash, chunk_hash)) is not None
+    if applied and resume:
+        log.add(skipped=len(chunk))
+        return
 
-    def create_vehicle_callable(line: str) -> None:
-        """
-        closure that updates count variable
-        """
+    vehicles = []
+    for record in chunk:
         try:
-            vehicle = _parse_line(line)
-            existing_vehicle = (
-                session.query(models.Vehicle).filter_by(plate=vehicle.plate).first()
+            vehicles.append(_build_vehicle(record))
+        except Exception as ex:
+            log.error(record, ex)
+    existing_vehicles = {
+        vehicle.plate: vehicle
+        for vehicle in session.execute(
+            select(models.Vehicle).where(
+                models.Vehicle.plate.in_([vehicle.plate for vehicle in vehicles])
             )
-            if not existing_vehicle:
-                session.add(vehicle)
-            else:
-                logging.info(f"Vehicle {vehicle.plate} already exists. Updating...")
-                vehicle.id = existing_vehicle.id
-                session.merge(vehicle)
-            session.commit()
-            redis_api.set_vehicle(
-                vehicle.plate,
-                datetime.datetime.fromtimestamp(
-                    vehicle.start_time.timestamp()
-                    + _calculate_end_time(
-                        vehicle.current_charge,
-                        vehicle.total_charge,
-                        vehicle.desired_percentage,
+        ).scalars()
+    }
+
+    to_import = []
+    skipped = 0
+    for vehicle in vehicles:
+        existing_vehicle = existing_vehicles.get(vehicle.plate)
+        if (
+            existing_vehicle is not None
+            and existing_vehicle.parked
+            and existing_vehicle.source_hash == vehicle.source_hash
+        ):
+            skipped += 1
+            continue
+        if existing_vehicle is None:
+            existing_vehicles[vehicle.plate] = vehicle
+        to_import.append((vehicle, existing_vehicle))
+
+    try:
+        # flush the whole chunk at once, rows were validated already
+        with session.begin_nested():
+            for vehicle, existing_vehicle in to_import:
+                _apply_vehicle(vehicle, existing_vehicle, session)
+        imported = to_import
+    except Exception as ex:
+        logging.warning(f"Could not import chunk at once due to: {ex}, retrying by row")
+        imported = []
+        for vehicle, existing_vehicle in to_import:
+            try:
+                with session.begin_nested():
+                    _apply_vehicle(vehicle, existing_vehicle, session)
+                imported.append((vehicle, existing_vehicle))
+            except Exception as ex:
+                log.error(vehicle.plate, ex)
+    # read before the commit expires the new vehicles
+    end_times = [
+        (
+            vehicle.plate,
+            _calculate_end_of_charge(
+                vehicle.start_time,
+                vehicle.current_charge,
+                vehicle.total_charge,
+                vehicle.desired_percentage,
+            ),
+        )
+        for vehicle, _ in imported
+    ]
+    if not applied:
+        session.execute(
+            insert(models.ImportChunk)
+            .values(manifest_hash=manifest_hash, content_hash=chunk_hash)
+            .on_conflict_do_nothing()
+        )
+        _record_plates(manifest_hash, [vehicle.plate for vehicle in vehicles], session)
+    # Redis is written before the commit: retries compare rows with the DB only,
+    # a chunk committed without its Redis keys would never be written to Redis again
+    try:
+        redis_api.set_vehicles(end_times)
+    except Exception:
+        session.rollback()
+        raise
+    session.commit()
+    log.add(
+        imported=len(imported),
+        updated=sum(existing is not None for _, existing in imported),
+        skipped=skipped,
+    )
+
+
+def _record_plates(manifest_hash: str, plates: list[str], session: Session) -> None:
+    if plates:
+        session.execute(
+            insert(models.ImportManifestVehicle)
+            .values(
+                [
+                    {"manifest_hash": manifest_hash, "plate": plate}
+                    for plate in dict.fromkeys(plates)
+                ]
+            )
+            .on_conflict_do_nothing()
+        )
+
+
+def _get_manifest(
+    manifest_hash: str, session: Session
+) -> tuple[models.ImportManifest | None, bool]:
+    """
+    :return: manifest or None if unknown, whether a vehicle it imported is no longer parked
+    """
+    removed = exists().where(
+        models.ImportManifestVehicle.manifest_hash
+        == models.ImportManifest.content_hash,
+        models.ImportManifestVehicle.plate == models.Vehicle.plate,
+        models.Vehicle.parked.is_(False),
+    )
+    row = session.execute(
+        select(models.ImportManifest, removed).where(
+            models.ImportManifest.content_hash == manifest_hash
+        )
+    ).first()
+    return (row[0], row[1]) if row is not None else (None, False)
+
+
+def _apply_vehicle(
+    vehicle: models.Vehicle, existing_vehicle: models.Vehicle | None, session: Session
+) -> None:
+    if existing_vehicle is None:
+        session.add(vehicle)
+        return
+    for field in _VEHICLE_STATE_FIELDS:
+        setattr(existing_vehicle, field, getattr(vehicle, field))
+
+
+def _copy_and_merge(
+    records: typing.Iterable[dict],
+    manifest_hash: str,
+    session: Session,
+    log: ImportLog,
+) -> None:
+    """
+    Stage records in a CSV file, copy it into a temporary table and upsert it into vehicles.
+    Rows matching the stored state of a parked vehicle are left untouched.
+    :param records: records
+    :param manifest_hash: content hash of the file the records belong to
+    :param session: db session
+    :param log: import log, updated with the outcome of the import
+    :return: None
+    """
+    with tempfile.TemporaryFile("w+", newline="") as staging:
+        writer = csv.writer(staging)
+        staged = 0
+        for record in records:
+            try:
+                row = _validate_record(record)
+            except Exception as ex:
+                log.error(record, ex)
+                continue
+            writer.writerow((*row, _hash_row(row)))
+            staged += 1
+        staging.seek(0)
+
+        start_time = datetime.datetime.now(tz=pytz.utc)
+        try:
+            cursor = session.connection().connection.cursor()
+            try:
+                cursor.execute(_CREATE_STAGING_SQL)
+                cursor.copy_expert(_COPY_STAGING_SQL, staging)
+            finally:
+                cursor.close()
+            rows = session.execute(
+                text(_MERGE_STAGING_SQL), {"start_time": start_time}
+            ).all()
+            session.execute(
+                text(_RECORD_STAGED_PLATES_SQL), {"manifest_hash": manifest_hash}
+            )
+            # before the commit, as in _import_chunk
+            redis_api.set_vehicles(
+                [
+                    (
+                        plate,
+                        _calculate_end_of_charge(
+                            start_time, current_charge, total_charge, desired_percentage
+                        ),
                     )
-                ),
+                    for plate, current_charge, total_charge, desired_percentage in rows
+                ]
             )
-            nonlocal count
-            count += 1
-            logging.info(f"Imported vehicle with plate {vehicle.plate}")
+            session.commit()
         except Exception as ex:
             session.rollback()
-            logging.error(f"Could not import vehicle: {line} due to: {ex}")
+            logging.error(f"Could not bulk import {log.source} due to: {ex}")
+            return
 
-    await _stream_data(url, create_vehicle_callable)
-    return count
+    log.add(imported=len(rows), skipped=staged - len(rows))
 
 
-def update_and_retrieve_ready(session: Session) -> list[models.Vehicle]:
+def update_and_retrieve_ready(session: Session) -> list[str]:
     """
-    Retrieve a list of vehicles ready for pickup and update DB with current charge of all vehicles
+    Retrieve a list of vehicles ready for pickup and update DB with current charge of all vehicles.
+    With write-behind enabled, the DB is updated by the background flusher.
     :param session: db session
-    :return: list of vehicles ready for pickup
+    :return: list of plates of the vehicles ready for pickup
     """
-    vehicles = redis_api.retrieve_all()
+    end_times = dict(redis_api.retrieve_all())
     current_time = datetime.datetime.now(tz=pytz.utc)
 
-    ready_vehicles = []
-    if not vehicles:
+    ready_plates = []
+    if not end_times:
         logging.warning("No vehicles found in Redis")
-    for plate, end_time in vehicles:
-        vehicle = session.execute(
-            select(models.Vehicle).filter_by(plate=plate)
-        ).scalar_one()
+        return ready_plates
+    vehicles = (
+        session.execute(
+            select(models.Vehicle).where(models.Vehicle.plate.in_(end_times))
+        )
+        .scalars()
+        .all()
+    )
+    for vehicle in vehicles:
         vehicle.current_charge = _calculate_current_charge(
             vehicle.current_charge,
             vehicle.total_charge,
@@ -82,17 +418,18 @@ def update_and_retrieve_ready(session: Session) -> list[models.Vehicle]:
             current_time,
         )
         vehicle.start_time = current_time
-        if end_time <= current_time:
-            ready_vehicles.append(vehicle)
+        if end_times[vehicle.plate] <= current_time:
+            ready_plates.append(vehicle.plate)
     logging.info(f"Updated {len(vehicles)} vehicles")
-    session.commit()
-    return ready_vehicles
+    _save(vehicles, session)
+    return ready_plates
 
 
 def remove_vehicle(plate: str, session: Session) -> int:
     """
     Remove a vehicle from the system.
-    This means that the vehicle is removed from the db and is set as not parked in the DB
+    This means that the vehicle is removed from the db and is set as not parked in the DB.
+    With write-behind enabled, the DB is updated by the background flusher.
     :param plate: vehicle plate
     :param session: db session
     :return: current charge of the vehicle
@@ -112,7 +449,7 @@ def remove_vehicle(plate: str, session: Session) -> int:
         datetime.datetime.now(tz=pytz.utc),
     )
     vehicle.current_charge = current_charge
-    session.commit()
+    _save([vehicle], session)
     return current_charge
 
 
@@ -133,28 +470,154 @@ def get_vehicle(plate: str) -> [datetime.datetime, bool]:
     )
 
 
+def _save(vehicles: list[models.Vehicle], session: Session) -> None:
+    """
+    Persist the charge state of vehicles, either now or through the write-behind queue
+    :param vehicles: vehicles changed in the session
+    :param session: db session
+    :return: None
+    """
+    if write_behind.enabled():
+        write_behind.enqueue(vehicles)
+    else:
+        session.commit()
+
+
 def _calculate_end_time(current_charge: int, total_charge: int, desired: int) -> int:
     current_percentage = current_charge * 100 / total_charge
     return max(0, int(desired - current_percentage))
 
 
-def _parse_line(line: str) -> models.Vehicle:
-    plate, current_charge, total_charge, desired_percentage = line.split(",")
+def _calculate_end_of_charge(
+    start_time: datetime.datetime,
+    current_charge: int,
+    total_charge: int,
+    desired: int,
+) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(
+        start_time.timestamp()
+        + _calculate_end_time(current_charge, total_charge, desired)
+    )
+
+
+def _validate_record(record: dict) -> tuple[str, int, int, int]:
+    """
+    Validate a parsed record against the constraints of the vehicles table
+    :param record: record with the vehicle fields
+    :return: plate, current_charge, total_charge, desired_percentage
+    """
+    plate = record["plate"]
+    if not isinstance(plate, str):
+        raise ValueError(f"invalid plate {plate!r}")
+    plate = plate.strip()
+    current_charge = _parse_int(record["current_charge"])
+    total_charge = _parse_int(record["total_charge"])
+    desired_percentage = _parse_int(record["desired_percentage"])
+    if not 0 < len(plate) <= 20 or redis_api.is_internal(plate):
+        raise ValueError(f"invalid plate {plate!r}")
+    if not 0 <= current_charge <= total_charge or total_charge == 0:
+        raise ValueError(f"invalid charge {current_charge}/{total_charge}")
+    if not 0 <= desired_percentage <= 100:
+        raise ValueError(f"invalid desired percentage {desired_percentage}")
+    return plate, current_charge, total_charge, desired_percentage
+
+
+def _parse_int(value) -> int:
+    """
+    Convert a field to int, rejecting non-integral numbers instead of truncating them
+    :param value: str from CSV, number from NDJSON, Arrow or Parquet
+    :return: integer value
+    """
+    if isinstance(value, bool):
+        raise ValueError(f"invalid integer {value!r}")
+    if isinstance(value, (int, str)):
+        return int(value)
+    number = int(value)
+    if number != value:
+        raise ValueError(f"invalid integer {value!r}")
+    return number
+
+
+def _build_vehicle(record: dict) -> models.Vehicle:
+    row = _validate_record(record)
+    plate, current_charge, total_charge, desired_percentage = row
     return models.Vehicle(
         plate=plate,
-        current_charge=int(current_charge),
-        total_charge=int(total_charge),
-        desired_percentage=int(desired_percentage),
+        current_charge=current_charge,
+        total_charge=total_charge,
+        desired_percentage=desired_percentage,
         start_time=datetime.datetime.now(tz=pytz.utc),
         parked=True,
+        source_hash=_hash_row(row),
     )
 
 
-async def _stream_data(url: str, add_vehicle_callable: typing.Callable) -> None:
+def _hash_row(row: tuple[str, int, int, int]) -> str:
+    return hashlib.sha256(",".join(map(str, row)).encode()).hexdigest()
+
+
+def _hash_records(records: list[dict]) -> str:
+    return hashlib.sha256(
+        json.dumps(records, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def _hash_file(file: typing.BinaryIO, data_format: models.DataFormat) -> str:
+    """
+    Hash the content of a file; text files are also checked to be valid UTF-8,
+    so that decoding cannot fail halfway through the import
+    """
+    content_hash = hashlib.sha256(data_format.value.encode())
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    try:
+        for block in iter(lambda: file.read(_HASH_BLOCK_SIZE), b""):
+            content_hash.update(block)
+            if data_format in parsers.TEXT_FORMATS:
+                decoder.decode(block)
+        decoder.decode(b"", final=True)
+    except UnicodeDecodeError as ex:
+        raise InvalidFileError(data_format.value, ex)
+    file.seek(0)
+    return content_hash.hexdigest()
+
+
+def _iter_chunks(
+    records: typing.Iterable[dict], size: int
+) -> typing.Iterator[list[dict]]:
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def _stream_data(url: str, buffer: typing.BinaryIO) -> None:
     async with httpx.AsyncClient() as client:
         async with client.stream("GET", url) as response:
-            async for line in response.aiter_lines():
-                add_vehicle_callable(line)
+            async for chunk in response.aiter_bytes():
+                buffer.write(chunk)
+
+
+def _iter_records(
+    file: typing.BinaryIO, data_format: models.DataFormat, log: ImportLog
+) -> typing.Iterator[dict]:
+    if data_format not in parsers.TEXT_FORMATS:
+        return parsers.iter_binary_records(file, data_format)
+    return _iter_text_records(file, data_format, log)
+
+
+def _iter_text_records(
+    file: typing.BinaryIO, data_format: models.DataFormat, log: ImportLog
+) -> typing.Iterator[dict]:
+    text = io.TextIOWrapper(file, encoding="utf-8", newline="")
+    try:
+        yield from parsers.iter_text_records(text, data_format, log.error)
+    finally:
+        # leave the underlying file open for its owner
+        text.detach()
 
 
 def _calculate_current_charge(
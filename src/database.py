@@ -8,7 +8,38 @@ SQLALCHEMY_DATABASE_URL = (
 )
 
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+# SQLAlchemy's default pool, the most a worker opens even when Postgres allows more
+MAX_POOL_SIZE = 5
+MAX_OVERFLOW = 10
+
+
+def pool_limits(max_connections: int, workers: int) -> tuple[int, int]:
+    """
+    Split the connections allowed by Postgres between the worker processes
+    :param max_connections: connections available to the whole application
+    :param workers: number of worker processes
+    :return: pool size and max overflow of the pool of each worker
+    :raises ValueError: when there are fewer connections than workers
+    """
+    per_worker = max_connections // workers
+    if per_worker < 1:
+        raise ValueError(
+            f"DB_MAX_CONNECTIONS ({max_connections}) leaves no connection "
+            f"to some of the {workers} workers"
+        )
+    pool_size = min(per_worker, MAX_POOL_SIZE)
+    return pool_size, min(per_worker - pool_size, MAX_OVERFLOW)
+
+
+pool_size, max_overflow = pool_limits(params.DB_MAX_CONNECTIONS, params.WORKERS)
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    pool_size=pool_size,
+    max_overflow=max_overflow,
+    # psycopg2 would send the parameter sets of an executemany (e.g. the UPDATE of all
+    # the vehicles changed in a session) one by one, batch them in pages instead
+    executemany_mode="values_plus_batch",
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 
@@ -1,3 +1,14 @@
 class VehicleDoesNotExistError(Exception):
     def __init__(self, plate):
         super().__init__(f"The vehicle with plate {plate} does not exist.")
+
+
+class UnsupportedFormatError(Exception):
+    def __init__(self, data_format, reason=None):
+        message = f"The data format {data_format} is not supported"
+        super().__init__(f"{message}: {reason}." if reason else f"{message}.")
+
+
+class InvalidFileError(Exception):
+    def __init__(self, data_format, reason):
+        super().__init__(f"The file is not a valid {data_format} file: {reason}.")
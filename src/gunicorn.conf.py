@@ -0,0 +1,18 @@
+"""
+Gunicorn settings for the multi-worker serving mode: gunicorn -c gunicorn.conf.py app:app
+Each worker is an independent uvicorn process with its own DB and Redis pools,
+accepting connections on the socket bound by the master.
+"""
+
+from config import params
+
+bind = f"{params.HOST}:{params.PORT}"
+workers = params.WORKERS
+worker_class = "uvicorn.workers.UvicornWorker"
+# set SO_REUSEPORT on the listening socket, so that a new master can bind it on upgrade
+reuse_port = True
+# recycle workers after a number of requests, with jitter so that they do not restart together
+max_requests = params.WORKER_MAX_REQUESTS
+max_requests_jitter = params.WORKER_MAX_REQUESTS_JITTER
+graceful_timeout = params.GRACEFUL_TIMEOUT
+loglevel = "info"
@@ -0,0 +1,62 @@
+import json
+import logging
+import time
+
+from config import params
+
+MAX_LOGGED_ERRORS = 10
+
+
+class ImportLog:
+    """
+    Outcome of an import, logged as a summary at most every IMPORT_LOG_INTERVAL seconds
+    and once at the end, instead of one line per row.
+    Only the first MAX_LOGGED_ERRORS errors are logged with their details.
+    """
+
+    def __init__(self, source: str):
+        self.source = source
+        self.imported = 0
+        self.updated = 0
+        self.skipped = 0
+        self.failed = 0
+        self._started = time.monotonic()
+        self._last_logged = self._started
+
+    def add(self, imported: int = 0, updated: int = 0, skipped: int = 0) -> None:
+        """
+        :param imported: rows written, including updated ones
+        :param updated: rows written over an existing vehicle
+        :param skipped: rows already up to date
+        """
+        self.imported += imported
+        self.updated += updated
+        self.skipped += skipped
+        self._log_progress()
+
+    def error(self, item, ex: Exception) -> None:
+        self.failed += 1
+        if self.failed <= MAX_LOGGED_ERRORS:
+            logging.error(f"Could not import {item} from {self.source} due to: {ex}")
+        elif self.failed == MAX_LOGGED_ERRORS + 1:
+            logging.error(f"Too many errors importing {self.source}, counting only")
+        self._log_progress()
+
+    def summary(self) -> dict:
+        return {
+            "source": self.source,
+            "imported": self.imported,
+            "updated": self.updated,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "elapsed_seconds": round(time.monotonic() - self._started, 3),
+        }
+
+    def done(self) -> None:
+        logging.info(f"Import completed {json.dumps(self.summary())}")
+
+    def _log_progress(self) -> None:
+        now = time.monotonic()
+        if now - self._last_logged >= params.IMPORT_LOG_INTERVAL:
+            self._last_logged = now
+            logging.info(f"Import in progress {json.dumps(self.summary())}")
@@ -0,0 +1,57 @@
+import logging
+import os
+import socket
+import uuid
+
+from redis.exceptions import WatchError
+
+import redis_api
+
+
+class LeaderLease:
+    """
+    Lease on a Redis key, held by at most one worker process at a time.
+    Used to run periodic jobs on a single worker; the lease must be renewed before it expires.
+    """
+
+    def __init__(self, name: str, ttl_ms: int):
+        self.key = f"{redis_api.INTERNAL_PREFIX}leader:{name}"
+        self.ttl_ms = ttl_ms
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    def acquire(self) -> bool:
+        """
+        Acquire the lease or renew it if already held by this worker
+        :return: whether this worker holds the lease
+        """
+        if redis_api.redis.set(self.key, self.owner, nx=True, px=self.ttl_ms):
+            logging.info(f"{self.owner} acquired {self.key}")
+            return True
+        with redis_api.redis.pipeline() as pipeline:
+            try:
+                # renew only if the lease did not expire and pass to another worker
+                pipeline.watch(self.key)
+                if pipeline.get(self.key) != self.owner.encode():
+                    return False
+                pipeline.multi()
+                pipeline.pexpire(self.key, self.ttl_ms)
+                pipeline.execute()
+                return True
+            except WatchError:
+                return False
+
+    def release(self) -> None:
+        """
+        Release the lease if held by this worker, so that another one can take over
+        :return: None
+        """
+        with redis_api.redis.pipeline() as pipeline:
+            try:
+                pipeline.watch(self.key)
+                if pipeline.get(self.key) != self.owner.encode():
+                    return
+                pipeline.multi()
+                pipeline.delete(self.key)
+                pipeline.execute()
+            except WatchError:
+                pass
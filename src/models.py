@@ -1,4 +1,5 @@
 import datetime
+import enum
 
 from pydantic import BaseModel
 from sqlalchemy import (
@@ -9,6 +10,7 @@ from sqlalchemy import (
     DateTime,
     func,
     Boolean,
+    ForeignKey,
 )
 from database import Base
 
@@ -23,6 +25,7 @@ class Vehicle(Base):
     start_time = Column(DateTime(timezone=True), server_default=func.now())
     desired_percentage = Column(Integer)
     parked = Column(Boolean, default=True)
+    source_hash = Column(String(64))
 
     __table_args__ = (
         CheckConstraint(current_charge >= 0, name="check_current_charge_non_negative"),
@@ -42,8 +45,49 @@ class Vehicle(Base):
     )
 
 
+class ImportManifest(Base):
+    __tablename__ = "import_manifests"
+
+    content_hash = Column(String(64), primary_key=True)
+    data_format = Column(String(10))
+    rows = Column(Integer, default=0)
+    completed = Column(Boolean, default=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class ImportChunk(Base):
+    __tablename__ = "import_chunks"
+
+    manifest_hash = Column(
+        String(64),
+        ForeignKey("import_manifests.content_hash", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    content_hash = Column(String(64), primary_key=True)
+
+
+class ImportManifestVehicle(Base):
+    __tablename__ = "import_manifest_vehicles"
+
+    manifest_hash = Column(
+        String(64),
+        ForeignKey("import_manifests.content_hash", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    plate = Column(String(20), primary_key=True)
+
+
+class DataFormat(str, enum.Enum):
+    CSV = "csv"
+    NDJSON = "ndjson"
+    ARROW = "arrow"
+    PARQUET = "parquet"
+
+
 class PostDataBody(BaseModel):
     url: str
+    data_format: DataFormat = DataFormat.CSV
+    bulk: bool = False
 
 
 class GetDataResponse(BaseModel):
@@ -52,6 +96,7 @@ class GetDataResponse(BaseModel):
 
 class PostDataResponse(BaseModel):
     imported: int
+    skipped: int = 0
 
 
 class GetVehicleResponse(BaseModel):
@@ -61,3 +106,9 @@ class GetVehicleResponse(BaseModel):
 
 class DeleteVehicleResponse(BaseModel):
     current_charge: int
+
+
+class WriteBehindStatusResponse(BaseModel):
+    enabled: bool
+    pending: int
+    lag_seconds: float | None = None
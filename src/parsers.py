@@ -0,0 +1,120 @@
+import csv
+import json
+import typing
+
+import models
+from exceptions import InvalidFileError, UnsupportedFormatError
+
+FIELDS = ("plate", "current_charge", "total_charge", "desired_percentage")
+
+TEXT_FORMATS = (models.DataFormat.CSV, models.DataFormat.NDJSON)
+
+
+def iter_text_records(
+    text: typing.TextIO,
+    data_format: models.DataFormat,
+    on_error: typing.Callable[[typing.Any, Exception], None],
+) -> typing.Iterator[dict]:
+    """
+    Iterate over the records of a CSV or NDJSON text stream, skipping blank lines.
+    CSV is read with a single csv.reader over the stream, so quoted fields may span lines.
+    :param text: text stream
+    :param data_format: CSV or NDJSON
+    :param on_error: called with the raw row and the exception for each invalid row
+    :return: iterator of records with the vehicle fields
+    """
+    if data_format == models.DataFormat.CSV:
+        rows, parse = _iter_csv_rows(text, on_error), _parse_csv_row
+    elif data_format == models.DataFormat.NDJSON:
+        rows, parse = (line.rstrip("\r\n") for line in text), _parse_ndjson_line
+    else:
+        raise UnsupportedFormatError(data_format)
+    for row in rows:
+        try:
+            record = parse(row)
+        except Exception as ex:
+            on_error(row, ex)
+            continue
+        if record is not None:
+            yield record
+
+
+def iter_binary_records(
+    file: typing.BinaryIO, data_format: models.DataFormat
+) -> typing.Iterator[dict]:
+    """
+    Iterate over the records of an Arrow IPC or Parquet file, one batch at a time.
+    The file is opened and its columns checked right away, so that an unreadable file
+    raises InvalidFileError before any record is consumed. Requires pyarrow to be installed.
+    :param file: seekable binary file
+    :param data_format: ARROW or PARQUET
+    :return: iterator of records with the vehicle fields
+    """
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise UnsupportedFormatError(data_format, "pyarrow is not installed")
+
+    try:
+        if data_format == models.DataFormat.PARQUET:
+            parquet_file = pyarrow.parquet.ParquetFile(file)
+            columns = parquet_file.schema_arrow.names
+            batches = parquet_file.iter_batches(columns=list(FIELDS))
+        elif data_format == models.DataFormat.ARROW:
+            reader = pyarrow.ipc.open_file(file)
+            columns = reader.schema.names
+            batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+        else:
+            raise UnsupportedFormatError(data_format)
+    except pyarrow.ArrowException as ex:
+        raise InvalidFileError(data_format.value, ex)
+    missing = [field for field in FIELDS if field not in columns]
+    if missing:
+        raise InvalidFileError(data_format.value, f"missing columns {missing}")
+    return _iter_batches(batches, data_format)
+
+
+def _iter_batches(
+    batches: typing.Iterator, data_format: models.DataFormat
+) -> typing.Iterator[dict]:
+    import pyarrow
+
+    try:
+        for batch in batches:
+            for row in batch.to_pylist():
+                yield {field: row[field] for field in FIELDS}
+    except pyarrow.ArrowException as ex:
+        raise InvalidFileError(data_format.value, ex)
+
+
+def _iter_csv_rows(
+    text: typing.TextIO, on_error: typing.Callable[[typing.Any, Exception], None]
+) -> typing.Iterator[list[str]]:
+    reader = csv.reader(text)
+    while True:
+        try:
+            yield next(reader)
+        except StopIteration:
+            return
+        except csv.Error as ex:
+            # the reader skips the malformed row and can go on
+            on_error(f"line {reader.line_num}", ex)
+
+
+def _parse_csv_row(row: list[str]) -> dict | None:
+    if not any(value.strip() for value in row):
+        return None
+    if len(row) != len(FIELDS):
+        raise ValueError(f"expected {len(FIELDS)} fields, got {len(row)}")
+    return dict(zip(FIELDS, (value.strip() for value in row)))
+
+
+def _parse_ndjson_line(line: str) -> dict | None:
+    if not line.strip():
+        return None
+    document = json.loads(line)
+    if not isinstance(document, dict):
+        raise ValueError("expected a JSON object")
+    return {field: document[field] for field in FIELDS}
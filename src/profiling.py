@@ -0,0 +1,150 @@
+import asyncio
+import cProfile
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+
+from fastapi import Request, Response
+from sqlalchemy import event
+from starlette.routing import Match
+
+import request_profile
+from config import params
+from database import engine
+
+PROFILE_HEADER = "X-Profile"
+
+# header values asking for a full profile of the request, any other value only counts
+CPROFILE = "cprofile"
+PYINSTRUMENT = "pyinstrument"
+
+# only one cProfile or pyinstrument profiler can run at a time
+_profiler_lock = threading.Lock()
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if request_profile.current() is not None:
+        conn.info.setdefault("profile_start", []).append(time.perf_counter())
+
+
+@event.listens_for(engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = request_profile.current()
+    if profile is not None and conn.info.get("profile_start"):
+        profile.sql_seconds += time.perf_counter() - conn.info["profile_start"].pop()
+        profile.sql_statements += 1
+
+
+async def profile_request(request: Request, call_next) -> Response:
+    """
+    HTTP middleware profiling requests with the X-Profile header or sampled at
+    PROFILE_SAMPLE_RATE. The app installs it only when PROFILING is set.
+    Counts and times are returned in the Server-Timing header and logged;
+    with X-Profile: cprofile or pyinstrument, a profile dump is written to PROFILE_DIR.
+    Profilers trace the event loop thread only: dumps are limited to async endpoints,
+    and also hold the work of the requests served concurrently.
+    """
+    mode = _profile_mode(request)
+    if mode is None:
+        return await call_next(request)
+
+    profile_id = uuid.uuid4().hex
+    token = request_profile.start()
+    profile = request_profile.current()
+    profiler = _start_profiler(mode, request)
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        total_seconds = time.perf_counter() - start
+        request_profile.stop(token)
+        dump = _stop_profiler(profiler, profile_id)
+
+    summary = {
+        "id": profile_id,
+        "method": request.method,
+        "path": request.url.path,
+        "status": response.status_code,
+        "total_ms": round(total_seconds * 1000, 3),
+        **profile.summary(),
+    }
+    if dump:
+        summary["dump"] = dump
+    logging.info(f"Request profile {json.dumps(summary)}")
+    response.headers["Server-Timing"] = profile.server_timing(total_seconds)
+    response.headers["X-Profile-Id"] = profile_id
+    return response
+
+
+def _profile_mode(request: Request) -> str | None:
+    mode = request.headers.get(PROFILE_HEADER, "").lower()
+    if mode:
+        return None if mode in ("0", "false", "no") else mode
+    if params.PROFILE_SAMPLE_RATE and random.random() < params.PROFILE_SAMPLE_RATE:
+        return "sampled"
+    return None
+
+
+def _is_async_endpoint(request: Request) -> bool:
+    for route in request.app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return asyncio.iscoroutinefunction(getattr(route, "endpoint", None))
+    return False
+
+
+def _start_profiler(mode: str, request: Request):
+    if mode not in (CPROFILE, PYINSTRUMENT):
+        return None
+    if not _is_async_endpoint(request):
+        # sync endpoints run in the threadpool, out of reach of the profiler
+        logging.warning(f"{request.url.path} is not an async endpoint, only counting")
+        return None
+    if not _profiler_lock.acquire(blocking=False):
+        logging.warning("Another request is being profiled, only counting")
+        return None
+    try:
+        if mode == CPROFILE:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            return profiler
+        try:
+            import pyinstrument
+        except ImportError:
+            logging.warning("pyinstrument is not installed, only counting")
+            _profiler_lock.release()
+            return None
+        profiler = pyinstrument.Profiler(async_mode="enabled")
+        profiler.start()
+        return profiler
+    except Exception:
+        _profiler_lock.release()
+        raise
+
+
+def _stop_profiler(profiler, profile_id: str) -> str | None:
+    """
+    :return: path of the profile dump or None if the request was not fully profiled
+    """
+    if profiler is None:
+        return None
+    try:
+        directory = params.PROFILE_DIR or tempfile.gettempdir()
+        if isinstance(profiler, cProfile.Profile):
+            profiler.disable()
+            path = os.path.join(directory, f"{profile_id}.prof")
+            profiler.dump_stats(path)
+        else:
+            profiler.stop()
+            path = os.path.join(directory, f"{profile_id}.html")
+            with open(path, "w") as output:
+                output.write(profiler.output_html())
+        return path
+    finally:
+        _profiler_lock.release()
@@ -3,23 +3,55 @@ import datetime
 import redis
 import pytz
 
+import request_profile
 from config import params
 
-pool = redis.ConnectionPool(host=f"{params.REDIS_ENDPOINT}", port=6379, db=0)
+# keys used by the application itself, all other keys are vehicle plates
+INTERNAL_PREFIX = "ampcontrol:"
+
+
+class ProfiledConnection(redis.Connection):
+    """
+    Connection reporting round trips and socket time to the profile of the current request
+    """
+
+    def send_packed_command(self, command, check_health=True):
+        with request_profile.redis_call(round_trip=True):
+            return super().send_packed_command(command, check_health)
+
+    def read_response(self, *args, **kwargs):
+        with request_profile.redis_call(round_trip=False):
+            return super().read_response(*args, **kwargs)
+
+
+pool = redis.ConnectionPool(
+    host=f"{params.REDIS_ENDPOINT}",
+    port=6379,
+    db=0,
+    connection_class=ProfiledConnection,
+)
 redis = redis.Redis(connection_pool=pool)
 
 
+def is_internal(key: str) -> bool:
+    """
+    :return: whether the key is used by the application itself and is not a vehicle plate
+    """
+    return key.startswith(INTERNAL_PREFIX)
+
+
 def get_vehicle(vehicle_plate: str) -> datetime.datetime | None:
     """
     Get vehicle expected end time or None if not found
     :param vehicle_plate:
     :return: expected date associated with the vehicle plate
     """
-    if redis.exists(vehicle_plate):
-        return datetime.datetime.fromtimestamp(
-            float(redis.get(vehicle_plate)), tz=pytz.utc
-        )
-    return None
+    if is_internal(vehicle_plate):
+        return None
+    value = redis.get(vehicle_plate)
+    if value is None:
+        return None
+    return datetime.datetime.fromtimestamp(float(value), tz=pytz.utc)
 
 
 def set_vehicle(vehicle_plate: str, dt: datetime.datetime) -> None:
@@ -32,13 +64,27 @@ def set_vehicle(vehicle_plate: str, dt: datetime.datetime) -> None:
     redis.set(vehicle_plate, dt.timestamp())
 
 
+def set_vehicles(vehicles: list[tuple[str, datetime.datetime]]) -> None:
+    """
+    Sets the expected end of charging of many vehicles in a single round trip
+    :param vehicles: list(plate, expected end of charging)
+    :return: None
+    """
+    if not vehicles:
+        return
+    pipeline = redis.pipeline(transaction=False)
+    for vehicle_plate, dt in vehicles:
+        pipeline.set(vehicle_plate, dt.timestamp())
+    pipeline.execute()
+
+
 def remove_vehicle(vehicle_plate: str) -> None:
     """
     Removes vehicle from redis
     :param vehicle_plate:
     :return: None
     """
-    if redis.exists(vehicle_plate):
+    if not is_internal(vehicle_plate):
         redis.delete(vehicle_plate)
 
 
@@ -46,14 +92,14 @@ def retrieve_all() -> list[tuple[str, datetime.datetime]]:
     """
     :return: all data in redis as a list(plate, endtime)
     """
+    plates = [key.decode() for key in redis.keys() if not is_internal(key.decode())]
+    if not plates:
+        return []
     vehicles = []
-    for key in redis.keys():
-        vehicles.append(
-            (
-                key.decode(),
-                datetime.datetime.fromtimestamp(
-                    float(redis.get(key.decode())), tz=pytz.utc
-                ),
+    for plate, value in zip(plates, redis.mget(plates)):
+        # the key may have been removed since it was listed
+        if value is not None:
+            vehicles.append(
+                (plate, datetime.datetime.fromtimestamp(float(value), tz=pytz.utc))
             )
-        )
     return vehicles
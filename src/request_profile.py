@@ -0,0 +1,72 @@
+import contextlib
+import contextvars
+import time
+
+
+class RequestProfile:
+    """
+    SQL statements and Redis round trips issued while serving a request.
+    """
+
+    def __init__(self):
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.redis_round_trips = 0
+        self.redis_seconds = 0.0
+
+    def summary(self) -> dict:
+        return {
+            "sql_statements": self.sql_statements,
+            "sql_ms": round(self.sql_seconds * 1000, 3),
+            "redis_round_trips": self.redis_round_trips,
+            "redis_ms": round(self.redis_seconds * 1000, 3),
+        }
+
+    def server_timing(self, total_seconds: float) -> str:
+        sql_ms = self.sql_seconds * 1000
+        redis_ms = self.redis_seconds * 1000
+        return (
+            f'sql;dur={sql_ms:.3f};desc="{self.sql_statements} statements", '
+            f'redis;dur={redis_ms:.3f};desc="{self.redis_round_trips} round trips", '
+            f"total;dur={total_seconds * 1000:.3f}"
+        )
+
+
+_current_profile = contextvars.ContextVar("current_profile", default=None)
+
+
+def current() -> RequestProfile | None:
+    """
+    :return: profile of the request being served or None if it is not profiled
+    """
+    return _current_profile.get()
+
+
+def start() -> contextvars.Token:
+    """
+    Start profiling the current request
+    :return: token to pass to stop()
+    """
+    return _current_profile.set(RequestProfile())
+
+
+def stop(token: contextvars.Token) -> None:
+    _current_profile.reset(token)
+
+
+@contextlib.contextmanager
+def redis_call(round_trip: bool):
+    """
+    Time a Redis socket operation for the current profile, if any
+    :param round_trip: whether the operation sends a request to the server
+    """
+    profile = _current_profile.get()
+    if profile is None:
+        yield
+        return
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.redis_seconds += time.perf_counter() - start_time
+        profile.redis_round_trips += round_trip
@@ -1,11 +1,15 @@
 import datetime
 
+import pytest
 import pytz
+import sqlalchemy
 from fastapi import FastAPI
 from fastapi.testclient import TestClient
 
+import app as app_module
 import models
 from app import app
+from database import engine
 
 from tests.utils import db_session, FakeRedisClient
 
@@ -65,3 +69,58 @@ class TestApp:
         )
         client.post("/data", json={"url": self.data_url})
         assert db_session.query(models.Vehicle).filter_by(parked=False).count() == 0
+
+    def test_upload_data(self, mocker, db_session):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        data = b"A0001,50,100,20\nA0002,50,100,90\n"
+        response = client.post(
+            "/data/upload", files={"file": ("vehicles.csv", data, "text/csv")}
+        )
+        assert response.status_code == 201
+        assert response.json()["imported"] == 2
+        assert db_session.query(models.Vehicle).count() == 2
+
+    def test_upload_data_not_utf8(self, mocker, db_session):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        data = "A0001,50,100,20\nÄ0002,50,100,90\n".encode("latin-1")
+        response = client.post(
+            "/data/upload", files={"file": ("vehicles.csv", data, "text/csv")}
+        )
+        assert response.status_code == 400
+        assert db_session.query(models.ImportManifest).count() == 0
+        assert db_session.query(models.Vehicle).count() == 0
+
+    def test_upload_data_corrupt_parquet(self, mocker, db_session):
+        pytest.importorskip("pyarrow")
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        response = client.post(
+            "/data/upload?data_format=parquet",
+            files={"file": ("vehicles.parquet", b"PAR1 corrupt", "text/csv")},
+        )
+        assert response.status_code == 400
+        assert db_session.query(models.ImportManifest).count() == 0
+
+    def test_internal_keys_are_not_vehicles(self, mocker, db_session):
+        redis_client = mocker.patch("redis_api.redis", FakeRedisClient())
+        redis_client.xadd("ampcontrol:vehicle-updates", {"changes": "[]"})
+        redis_client.set("ampcontrol:leader:write-behind", "owner")
+        for key in ("ampcontrol:vehicle-updates", "ampcontrol:leader:write-behind"):
+            assert client.get(f"/vehicle/{key}").status_code == 404
+            assert client.delete(f"/vehicle/{key}").status_code == 404
+        response = client.post(
+            "/data/upload",
+            files={"file": ("vehicles.csv", b"ampcontrol:x,50,100,20\n", "text/csv")},
+        )
+        assert response.status_code == 400
+        assert redis_client.exists("ampcontrol:leader:write-behind")
+
+
+class TestInitDb:
+    def test_init_db_is_idempotent(self):
+        app_module.init_db()
+        app_module.init_db()
+        columns = [
+            column["name"]
+            for column in sqlalchemy.inspect(engine).get_columns("vehicles")
+        ]
+        assert "source_hash" in columns
@@ -1,9 +1,12 @@
 import datetime
+import io
+import json
 
 import pytest
 
 import controller
 import models
+import parsers
 import redis_api
 from tests.utils import FakeRedisClient
 from exceptions import VehicleDoesNotExistError
@@ -35,9 +38,8 @@ def add_vehicle(
     return vehicle
 
 
-async def stream_data(url, callback, data):
-    for line in data.splitlines():
-        callback(line)
+async def stream_data(url, buffer, data):
+    buffer.write(data.encode())
 
 
 class TestVehicle:
@@ -123,3 +125,220 @@ A0004,50,100,80"""
         )
         await controller.import_data("", db_session)
         assert db_session.query(models.Vehicle).count() == 4
+
+    @pytest.mark.anyio
+    async def test_import_data_skips_invalid_lines(self, mocker, db_session):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        data = 'A0001,50,100,20\n\n"A,0002",50,100,90\nA0003,150,100,10\nA0004,50\n'
+        mocker.patch(
+            "controller._stream_data",
+            lambda *args, **kwargs: stream_data(data=data, *args, **kwargs),
+        )
+        imported, skipped = await controller.import_data("", db_session)
+        assert imported == 2
+        assert skipped == 0
+        assert db_session.query(models.Vehicle).filter_by(plate="A,0002").count() == 1
+
+    @pytest.mark.anyio
+    async def test_import_data_quoted_multiline_field(self, mocker, db_session):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        data = '"A\n0001",50,100,20\nA0002,50,100,90\n'
+        mocker.patch(
+            "controller._stream_data",
+            lambda *args, **kwargs: stream_data(data=data, *args, **kwargs),
+        )
+        assert await controller.import_data("", db_session) == (2, 0)
+        assert db_session.query(models.Vehicle).filter_by(plate="A\n0001").count() == 1
+
+    @pytest.mark.anyio
+    async def test_import_data_ndjson_rejects_invalid_types(self, mocker, db_session):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        documents = [
+            {"plate": None, "current_charge": 50},
+            {"plate": 1234, "current_charge": 50},
+            {"plate": "A0003", "current_charge": 50.5},
+            {"plate": "A0004", "current_charge": 50.0},
+        ]
+        data = "\n".join(
+            json.dumps({"total_charge": 100, "desired_percentage": 20, **document})
+            for document in documents
+        )
+        mocker.patch(
+            "controller._stream_data",
+            lambda *args, **kwargs: stream_data(data=data, *args, **kwargs),
+        )
+        imported, _ = await controller.import_data(
+            "", db_session, models.DataFormat.NDJSON
+        )
+        assert imported == 1
+        assert [vehicle.plate for vehicle in db_session.query(models.Vehicle)] == [
+            "A0004"
+        ]
+
+    @pytest.mark.anyio
+    async def test_import_upload_without_full_io_interface(self, mocker, db_session):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        buffer = io.BytesIO(self.data.encode())
+
+        class Upload:
+            """Like SpooledTemporaryFile on Python 3.10, which has no readable()"""
+
+            read = buffer.read
+            seek = buffer.seek
+
+        assert await controller.import_upload(Upload(), db_session) == (4, 0)
+
+    @pytest.mark.anyio
+    async def test_import_data_ndjson(self, mocker, db_session):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        data = "\n".join(
+            json.dumps(dict(zip(parsers.FIELDS, line.split(",")), current_charge=50))
+            for line in self.data.splitlines()
+        )
+        mocker.patch(
+            "controller._stream_data",
+            lambda *args, **kwargs: stream_data(data=data, *args, **kwargs),
+        )
+        await controller.import_data("", db_session, models.DataFormat.NDJSON)
+        assert db_session.query(models.Vehicle).count() == 4
+
+    @pytest.mark.anyio
+    async def test_import_file_bulk(self, mocker, db_session):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        add_vehicle(db_session, redis_api.redis, "A0001", current_charge=0)
+        data = self.data + "\nA0002,60,100,90\nA0005,500,100,10"
+        imported, skipped = await controller.import_file(
+            io.BytesIO(data.encode()), db_session, bulk=True
+        )
+        assert imported == 4
+        assert skipped == 1
+        assert db_session.query(models.Vehicle).count() == 4
+        assert (
+            db_session.query(models.Vehicle)
+            .filter_by(plate="A0001")
+            .one()
+            .current_charge
+            == 50
+        )
+        assert (
+            db_session.query(models.Vehicle)
+            .filter_by(plate="A0002")
+            .one()
+            .current_charge
+            == 60
+        )
+        assert len(redis_api.redis.keys()) == 4
+
+    @pytest.mark.anyio
+    async def test_import_file_twice_is_skipped(self, mocker, db_session):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        data = self.data.encode()
+        assert await controller.import_file(io.BytesIO(data), db_session) == (4, 0)
+        start_time = db_session.query(models.Vehicle).first().start_time
+        redis_set = mocker.spy(redis_api, "set_vehicle")
+        assert await controller.import_file(io.BytesIO(data), db_session) == (0, 4)
+        assert redis_set.call_count == 0
+        db_session.expire_all()
+        assert db_session.query(models.Vehicle).first().start_time == start_time
+
+    @pytest.mark.anyio
+    async def test_import_file_skips_unchanged_rows(self, mocker, db_session):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        await controller.import_file(io.BytesIO(self.data.encode()), db_session)
+        data = self.data.replace("A0002,50,100,90", "A0002,60,100,90")
+        imported, skipped = await controller.import_file(
+            io.BytesIO(data.encode()), db_session
+        )
+        assert (imported, skipped) == (1, 3)
+        assert (
+            db_session.query(models.Vehicle)
+            .filter_by(plate="A0002")
+            .one()
+            .current_charge
+            == 60
+        )
+
+    @pytest.mark.anyio
+    async def test_import_file_resumes_from_applied_chunks(self, mocker, db_session):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        mocker.patch("controller.params.IMPORT_CHUNK_SIZE", 2)
+        data = self.data.encode()
+        await controller.import_file(io.BytesIO(data), db_session)
+        assert db_session.query(models.ImportChunk).count() == 2
+        # simulate an import interrupted before the manifest was completed
+        db_session.query(models.ImportManifest).update({"completed": False})
+        db_session.commit()
+        build_vehicle = mocker.spy(controller, "_build_vehicle")
+        assert await controller.import_file(io.BytesIO(data), db_session) == (0, 4)
+        assert build_vehicle.call_count == 0
+
+    @pytest.mark.anyio
+    @pytest.mark.parametrize("bulk", [False, True])
+    async def test_redis_failure_is_retried(self, mocker, db_session, bulk):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        set_vehicles = redis_api.set_vehicles
+        calls = []
+
+        def fail_once(end_times):
+            calls.append(end_times)
+            if len(calls) == 1:
+                raise ConnectionError("Redis is down")
+            set_vehicles(end_times)
+
+        mocker.patch("redis_api.set_vehicles", fail_once)
+        data = self.data.encode()
+        try:
+            assert await controller.import_file(
+                io.BytesIO(data), db_session, bulk=bulk
+            ) == (0, 0)
+        except ConnectionError:
+            # the ORM path stops at the failed chunk
+            assert not bulk
+            db_session.rollback()
+        assert redis_api.redis.keys() == []
+        assert await controller.import_file(
+            io.BytesIO(data), db_session, bulk=bulk
+        ) == (4, 0)
+        assert len(redis_api.redis.keys()) == 4
+
+    @pytest.mark.anyio
+    async def test_overlapping_import_of_same_file(self, mocker, db_session):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        data = self.data.encode()
+        manifest_hash = controller._hash_file(io.BytesIO(data), models.DataFormat.CSV)
+        # another import recorded the manifest after this one looked it up
+        db_session.add(
+            models.ImportManifest(content_hash=manifest_hash, data_format="csv")
+        )
+        db_session.commit()
+        mocker.patch("controller._get_manifest", return_value=(None, False))
+        assert await controller.import_file(io.BytesIO(data), db_session) == (4, 0)
+        assert db_session.get(models.ImportManifest, manifest_hash).completed
+
+    @pytest.mark.anyio
+    async def test_removed_vehicle_is_parked_by_its_manifest(self, mocker, db_session):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        mocker.patch("controller.params.IMPORT_CHUNK_SIZE", 2)
+        data = self.data.encode()
+        other = b"A0005,50,100,20"
+        await controller.import_file(io.BytesIO(data), db_session)
+        await controller.import_file(io.BytesIO(other), db_session)
+        controller.remove_vehicle("A0001", db_session)
+        assert db_session.query(models.ImportManifest).count() == 2
+        # manifests without removed vehicles are still skipped without parsing
+        build_vehicle = mocker.spy(controller, "_build_vehicle")
+        assert await controller.import_file(io.BytesIO(other), db_session) == (0, 1)
+        assert build_vehicle.call_count == 0
+        assert await controller.import_file(io.BytesIO(data), db_session) == (1, 3)
+        assert db_session.query(models.Vehicle).filter_by(plate="A0001").one().parked
+
+    @pytest.mark.anyio
+    async def test_removed_vehicle_is_parked_by_bulk_import(self, mocker, db_session):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        data = self.data.encode()
+        await controller.import_file(io.BytesIO(data), db_session, bulk=True)
+        controller.remove_vehicle("A0001", db_session)
+        imported, skipped = await controller.import_file(
+            io.BytesIO(data), db_session, bulk=True
+        )
+        assert (imported, skipped) == (1, 3)
@@ -1,6 +1,8 @@
 import pytest
 import sqlalchemy.exc
+from sqlalchemy.dialects.postgresql.psycopg2 import EXECUTEMANY_VALUES_PLUS_BATCH
 
+import database
 import models
 from tests.utils import db_session
 
@@ -112,3 +114,20 @@ class TestDatabaseVehicleModel:
                 )
             )
             db_session.commit()
+
+
+class TestPoolLimits:
+    def test_single_worker_keeps_default_pool(self):
+        assert database.pool_limits(90, 1) == (5, 10)
+
+    def test_connections_are_split_between_workers(self):
+        assert database.pool_limits(90, 8) == (5, 6)
+        assert database.pool_limits(20, 8) == (2, 0)
+
+    def test_more_workers_than_connections(self):
+        with pytest.raises(ValueError):
+            database.pool_limits(2, 4)
+
+    def test_executemany_is_batched(self):
+        # QueryCounter counts executemany round trips assuming psycopg2 pages them
+        assert database.engine.dialect.executemany_mode is EXECUTEMANY_VALUES_PLUS_BATCH
@@ -0,0 +1,43 @@
+import time
+
+import leader
+import redis_api
+from tests.utils import FakeRedisClient
+
+
+class TestLeaderLease:
+    def test_acquire(self, mocker):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        lease = leader.LeaderLease("job", 1000)
+        assert lease.acquire()
+        assert redis_api.redis.get(lease.key) == lease.owner.encode()
+
+    def test_single_leader(self, mocker):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        first = leader.LeaderLease("job", 1000)
+        second = leader.LeaderLease("job", 1000)
+        assert first.acquire()
+        assert not second.acquire()
+        # renewal keeps the lease
+        assert first.acquire()
+        assert not second.acquire()
+
+    def test_release(self, mocker):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        first = leader.LeaderLease("job", 1000)
+        second = leader.LeaderLease("job", 1000)
+        assert first.acquire()
+        second.release()
+        assert not second.acquire()
+        first.release()
+        assert not redis_api.redis.exists(first.key)
+        assert second.acquire()
+
+    def test_expired_lease_passes_to_another_worker(self, mocker):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        first = leader.LeaderLease("job", 10)
+        second = leader.LeaderLease("job", 10)
+        assert first.acquire()
+        time.sleep(0.02)
+        assert second.acquire()
+        assert not first.acquire()
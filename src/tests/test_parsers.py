@@ -0,0 +1,145 @@
+import io
+import json
+
+import pytest
+
+import models
+import parsers
+from exceptions import InvalidFileError
+
+
+def parse(data, data_format=models.DataFormat.CSV):
+    errors = []
+    records = list(
+        parsers.iter_text_records(
+            io.StringIO(data, newline=""),
+            data_format,
+            lambda row, ex: errors.append(row),
+        )
+    )
+    return records, errors
+
+
+def write_table(data_format, columns):
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    table = pyarrow.table(columns)
+    sink = pyarrow.BufferOutputStream()
+    if data_format == models.DataFormat.PARQUET:
+        pyarrow.parquet.write_table(table, sink)
+    else:
+        with pyarrow.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    return io.BytesIO(sink.getvalue().to_pybytes())
+
+
+class TestParseRecords:
+    def test_parse_csv(self):
+        records, errors = parse("A0001,50,100,20\r\n")
+        assert records == [
+            {
+                "plate": "A0001",
+                "current_charge": "50",
+                "total_charge": "100",
+                "desired_percentage": "20",
+            }
+        ]
+        assert errors == []
+
+    def test_parse_csv_quoted(self):
+        records, _ = parse('"A,0001",50,100,20')
+        assert records[0]["plate"] == "A,0001"
+
+    def test_parse_blank_lines(self):
+        assert parse("\n  \n") == ([], [])
+        assert parse("\n  \n", models.DataFormat.NDJSON) == ([], [])
+
+    def test_parse_csv_wrong_fields(self):
+        assert parse("A0001,50,100") == ([], [["A0001", "50", "100"]])
+
+    def test_parse_ndjson(self):
+        document = {
+            "plate": "A0001",
+            "current_charge": 50,
+            "total_charge": 100,
+            "desired_percentage": 20,
+            "extra": True,
+        }
+        records, _ = parse(json.dumps(document), models.DataFormat.NDJSON)
+        assert records == [{field: document[field] for field in parsers.FIELDS}]
+
+    def test_parse_ndjson_not_object(self):
+        assert parse("[1, 2]", models.DataFormat.NDJSON) == ([], ["[1, 2]"])
+
+
+class TestIterTextRecords:
+    def test_csv_quoted_field_spans_lines(self):
+        text = io.StringIO('"A\n0001",50,100,20\r\nA0002,50,100,90\n', newline="")
+        records = list(
+            parsers.iter_text_records(text, models.DataFormat.CSV, pytest.fail)
+        )
+        assert [record["plate"] for record in records] == ["A\n0001", "A0002"]
+
+    def test_invalid_rows_are_reported(self):
+        errors = []
+        text = io.StringIO('A0001,50,100,20\n\nA0002,50\n{"plate": "A0003"}\n')
+        records = list(
+            parsers.iter_text_records(
+                text,
+                models.DataFormat.CSV,
+                lambda row, ex: errors.append(row),
+            )
+        )
+        assert len(records) == 1
+        assert errors == [["A0002", "50"], ['{"plate": "A0003"}']]
+
+    def test_ndjson_skips_blank_lines(self):
+        text = io.StringIO('{"plate": "A0001"}\n\n')
+        errors = []
+        records = list(
+            parsers.iter_text_records(
+                text, models.DataFormat.NDJSON, lambda row, ex: errors.append(row)
+            )
+        )
+        # the object misses fields
+        assert records == []
+        assert errors == ['{"plate": "A0001"}']
+
+
+class TestBinaryRecords:
+    columns = {
+        "plate": ["A0001", None],
+        "current_charge": [50, 60],
+        "total_charge": [100, 100],
+        "desired_percentage": [20, 90],
+    }
+
+    @pytest.mark.parametrize(
+        "data_format", [models.DataFormat.ARROW, models.DataFormat.PARQUET]
+    )
+    def test_read(self, data_format):
+        file = write_table(data_format, {**self.columns, "extra": [1, 2]})
+        records = list(parsers.iter_binary_records(file, data_format))
+        assert records == [
+            dict(zip(parsers.FIELDS, values)) for values in zip(*self.columns.values())
+        ]
+
+    @pytest.mark.parametrize(
+        "data_format", [models.DataFormat.ARROW, models.DataFormat.PARQUET]
+    )
+    def test_missing_column(self, data_format):
+        columns = dict(self.columns)
+        del columns["total_charge"]
+        file = write_table(data_format, columns)
+        with pytest.raises(InvalidFileError):
+            parsers.iter_binary_records(file, data_format)
+
+    @pytest.mark.parametrize(
+        "data_format", [models.DataFormat.ARROW, models.DataFormat.PARQUET]
+    )
+    def test_corrupt_file(self, data_format):
+        pytest.importorskip("pyarrow")
+        with pytest.raises(InvalidFileError):
+            parsers.iter_binary_records(io.BytesIO(b"A0001,50,100,20\n"), data_format)
@@ -0,0 +1,105 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from app import app
+from tests.test_controller import add_vehicle
+from tests.utils import FakeRedisClient, QueryCounter, db_session
+
+pytestmark = pytest.mark.performance
+
+client = TestClient(app)
+
+
+def add_vehicles(session, redis_client, count):
+    for i in range(count):
+        add_vehicle(session, redis_client, f"P{i:04}", current_charge=i % 100)
+    redis_client.round_trips = 0
+
+
+def upload(data):
+    return client.post(
+        "/data/upload", files={"file": ("vehicles.csv", data.encode(), "text/csv")}
+    )
+
+
+class TestEndpointBudgets:
+    """
+    Number of SQL statements and Redis round trips per endpoint,
+    they must not grow with the number of vehicles.
+    """
+
+    @pytest.mark.parametrize("vehicles", [1, 25])
+    def test_get_data(self, mocker, db_session, vehicles):
+        redis_client = mocker.patch("redis_api.redis", FakeRedisClient())
+        add_vehicles(db_session, redis_client, vehicles)
+        with QueryCounter() as queries:
+            response = client.get("/data")
+        assert response.status_code == 200
+        assert queries.count <= 3
+        assert redis_client.round_trips <= 2
+
+    def test_get_data_write_behind(self, mocker, db_session):
+        import write_behind
+
+        redis_client = mocker.patch("redis_api.redis", FakeRedisClient())
+        mocker.patch("write_behind.queue", write_behind.RedisStreamQueue())
+        add_vehicles(db_session, redis_client, 25)
+        with QueryCounter() as queries:
+            response = client.get("/data")
+        assert response.status_code == 200
+        assert queries.count == 1
+        assert redis_client.round_trips <= 3
+
+    @pytest.mark.parametrize("vehicles", [1, 25])
+    def test_delete_vehicle(self, mocker, db_session, vehicles):
+        redis_client = mocker.patch("redis_api.redis", FakeRedisClient())
+        add_vehicles(db_session, redis_client, vehicles)
+        with QueryCounter() as queries:
+            response = client.delete("/vehicle/P0000")
+        assert response.status_code == 200
+        assert queries.count <= 3
+        assert redis_client.round_trips <= 2
+
+    def test_get_vehicle(self, mocker, db_session):
+        redis_client = mocker.patch("redis_api.redis", FakeRedisClient())
+        add_vehicles(db_session, redis_client, 25)
+        with QueryCounter() as queries:
+            response = client.get("/vehicle/P0000")
+        assert response.status_code == 200
+        assert queries.count == 0
+        assert redis_client.round_trips == 1
+
+    def test_import(self, mocker, db_session):
+        counts = []
+        for rows in (5, 50):
+            redis_client = mocker.patch("redis_api.redis", FakeRedisClient())
+            data = "\n".join(f"I{rows}-{i},50,100,80" for i in range(rows))
+            with QueryCounter() as queries:
+                response = upload(data)
+            assert response.status_code == 201
+            assert response.json()["imported"] == rows
+            assert redis_client.round_trips == 1
+            counts.append(queries.count)
+        assert counts[0] == counts[1] <= 10
+
+    def test_reimport_unchanged_rows(self, mocker, db_session):
+        redis_client = mocker.patch("redis_api.redis", FakeRedisClient())
+        data = "\n".join(f"R{i},50,100,80" for i in range(50))
+        upload(data)
+        redis_client.round_trips = 0
+        with QueryCounter() as queries:
+            response = upload(data + "\n")
+        assert response.json() == {"imported": 0, "skipped": 50}
+        assert queries.count <= 8
+        assert redis_client.round_trips == 0
+
+    def test_reimport_same_manifest(self, mocker, db_session):
+        redis_client = mocker.patch("redis_api.redis", FakeRedisClient())
+        data = "\n".join(f"M{i},50,100,80" for i in range(50))
+        upload(data)
+        redis_client.round_trips = 0
+        with QueryCounter() as queries:
+            response = upload(data)
+        assert response.json() == {"imported": 0, "skipped": 50}
+        assert queries.count == 1
+        assert redis_client.round_trips == 0
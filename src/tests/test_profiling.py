@@ -0,0 +1,104 @@
+import logging
+import re
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import import_log
+import profiling
+import request_profile
+from app import app
+from tests.test_controller import add_vehicle
+from tests.utils import FakeRedisClient, QueryCounter, db_session
+
+# the app installs the middleware only when PROFILING is set at startup, which it is not in tests
+profiled_app = FastAPI(routes=app.routes)
+profiled_app.middleware("http")(profiling.profile_request)
+client = TestClient(profiled_app)
+
+
+class TestProfiling:
+    def test_disabled(self, mocker, db_session):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        assert not app.user_middleware
+        response = TestClient(app).get("/data", headers={profiling.PROFILE_HEADER: "1"})
+        assert response.status_code == 200
+        assert "Server-Timing" not in response.headers
+
+    def test_not_requested(self, mocker, db_session):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        mocker.patch("profiling.params.PROFILE_SAMPLE_RATE", 0)
+        response = client.get("/data")
+        assert "Server-Timing" not in response.headers
+
+    def test_counts_sql_statements(self, mocker, db_session):
+        redis_client = mocker.patch("redis_api.redis", FakeRedisClient())
+        add_vehicle(db_session, redis_client, "A")
+        # the profile also counts the savepoints of the db_session fixture
+        with QueryCounter(savepoints=True) as queries:
+            response = client.get("/data", headers={profiling.PROFILE_HEADER: "1"})
+        assert response.status_code == 200
+        assert response.headers["X-Profile-Id"]
+        statements = re.search(
+            r'sql;dur=[\d.]+;desc="(\d+) statements"', response.headers["Server-Timing"]
+        )
+        assert len(queries.statements) > 0
+        assert int(statements.group(1)) == len(queries.statements)
+
+    def test_sampled(self, mocker, db_session):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        mocker.patch("profiling.params.PROFILE_SAMPLE_RATE", 1)
+        response = client.get("/data")
+        assert "Server-Timing" in response.headers
+
+    def test_cprofile_dump(self, mocker, db_session, tmp_path):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        mocker.patch("profiling.params.PROFILE_DIR", str(tmp_path))
+        response = client.get(
+            "/data", headers={profiling.PROFILE_HEADER: profiling.CPROFILE}
+        )
+        assert response.status_code == 200
+        assert (tmp_path / f"{response.headers['X-Profile-Id']}.prof").exists()
+
+    def test_no_dump_for_sync_endpoint(self, mocker, db_session, tmp_path):
+        redis_client = mocker.patch("redis_api.redis", FakeRedisClient())
+        mocker.patch("profiling.params.PROFILE_DIR", str(tmp_path))
+        add_vehicle(db_session, redis_client, "A")
+        response = client.delete(
+            "/vehicle/A", headers={profiling.PROFILE_HEADER: profiling.CPROFILE}
+        )
+        assert response.status_code == 200
+        assert "Server-Timing" in response.headers
+        assert list(tmp_path.iterdir()) == []
+
+    def test_redis_call(self):
+        token = request_profile.start()
+        try:
+            with request_profile.redis_call(round_trip=True):
+                pass
+            with request_profile.redis_call(round_trip=False):
+                pass
+            assert request_profile.current().redis_round_trips == 1
+        finally:
+            request_profile.stop(token)
+        assert request_profile.current() is None
+
+
+class TestImportLog:
+    def test_errors_are_rate_limited(self, caplog):
+        log = import_log.ImportLog("test")
+        with caplog.at_level(logging.ERROR):
+            for i in range(import_log.MAX_LOGGED_ERRORS + 5):
+                log.error(i, ValueError("invalid"))
+        assert len(caplog.records) == import_log.MAX_LOGGED_ERRORS + 1
+        assert log.failed == import_log.MAX_LOGGED_ERRORS + 5
+
+    def test_progress_is_rate_limited(self, mocker, caplog):
+        mocker.patch("import_log.params.IMPORT_LOG_INTERVAL", 3600)
+        log = import_log.ImportLog("test")
+        with caplog.at_level(logging.INFO):
+            for _ in range(100):
+                log.add(imported=1)
+            log.done()
+        assert len(caplog.records) == 1
+        assert '"imported": 100' in caplog.records[0].getMessage()
@@ -1,5 +1,6 @@
 import datetime
 
+import pytest
 import pytz
 
 import redis_api
@@ -28,3 +29,119 @@ class TestRedis:
         assert redis_api.redis.exists("XXXXX")
         redis_api.remove_vehicle("XXXXX")
         assert not redis_api.redis.exists("XXXXX")
+
+    def test_retrieve_all_skips_internal_keys(self, mocker):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        redis_api.set_vehicle("XXXXX", datetime.datetime.now())
+        redis_api.redis.set(f"{redis_api.INTERNAL_PREFIX}key", "value")
+        assert [plate for plate, _ in redis_api.retrieve_all()] == ["XXXXX"]
+
+    def test_set_vehicles(self, mocker):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        dt = datetime.datetime.now(tz=pytz.utc)
+        redis_api.set_vehicles([("XXXXX", dt), ("YYYYY", dt)])
+        assert redis_api.redis.round_trips == 1
+        assert redis_api.get_vehicle("XXXXX") == dt
+        assert redis_api.get_vehicle("YYYYY") == dt
+
+    def test_retrieve_all(self, mocker):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        dt = datetime.datetime.now(tz=pytz.utc)
+        redis_api.set_vehicles([("XXXXX", dt), ("YYYYY", dt)])
+        redis_api.redis.round_trips = 0
+        assert sorted(redis_api.retrieve_all()) == [("XXXXX", dt), ("YYYYY", dt)]
+        assert redis_api.redis.round_trips == 2
+
+    def test_internal_keys_are_not_vehicles(self, mocker):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        key = f"{redis_api.INTERNAL_PREFIX}vehicle-updates"
+        redis_api.redis.xadd(key, {"changes": "[]"})
+        assert redis_api.get_vehicle(key) is None
+        redis_api.remove_vehicle(key)
+        assert redis_api.redis.exists(key)
+
+
+class TestFakeRedisClient:
+    """
+    The fake must behave like Redis for the commands the application relies on.
+    """
+
+    def test_zadd_counts_new_members(self):
+        redis = FakeRedisClient()
+        assert redis.zadd("zset", {"a": 1, "b": 2}) == 2
+        assert redis.zadd("zset", {"a": 3, "c": 1}) == 1
+        assert redis.zscore("zset", "a") == 3.0
+        assert redis.zcard("zset") == 3
+
+    def test_zscore_of_missing_member(self):
+        redis = FakeRedisClient()
+        assert redis.zscore("zset", "a") is None
+        redis.zadd("zset", {"a": 1})
+        assert redis.zscore("zset", "b") is None
+
+    def test_zrem_deletes_empty_key(self):
+        redis = FakeRedisClient()
+        redis.zadd("zset", {"a": 1, "b": 2})
+        assert redis.zrem("zset", "a", "c") == 1
+        assert redis.exists("zset")
+        assert redis.zrem("zset", "b") == 1
+        assert not redis.exists("zset")
+        assert redis.zcard("zset") == 0
+
+    def test_zrange_orders_by_score_then_member(self):
+        redis = FakeRedisClient()
+        redis.zadd("zset", {"c": 1, "b": 1, "a": 2})
+        assert redis.zrange("zset", 0, -1) == [b"b", b"c", b"a"]
+        assert redis.zrange("zset", 0, -1, withscores=True) == [
+            (b"b", 1.0),
+            (b"c", 1.0),
+            (b"a", 2.0),
+        ]
+
+    @pytest.mark.parametrize(
+        "start, end, expected",
+        [
+            (0, 0, [b"a"]),
+            (1, 2, [b"b", b"c"]),
+            (-2, -1, [b"b", b"c"]),
+            (-10, 0, [b"a"]),
+            (0, 10, [b"a", b"b", b"c"]),
+            (2, 1, []),
+            (0, -10, []),
+            (5, -1, []),
+        ],
+    )
+    def test_zrange_indexes(self, start, end, expected):
+        redis = FakeRedisClient()
+        redis.zadd("zset", {"a": 1, "b": 2, "c": 3})
+        assert redis.zrange("zset", start, end) == expected
+
+    @pytest.mark.parametrize(
+        "low, high, expected",
+        [
+            (1, 2, [b"a", b"b"]),
+            ("(1", 3, [b"b", b"c"]),
+            (1, "(3", [b"a", b"b"]),
+            ("-inf", "+inf", [b"a", b"b", b"c"]),
+            (4, 5, []),
+        ],
+    )
+    def test_zrangebyscore_bounds(self, low, high, expected):
+        redis = FakeRedisClient()
+        redis.zadd("zset", {"a": 1, "b": 2, "c": 3})
+        assert redis.zrangebyscore("zset", low, high) == expected
+
+    def test_xrange_count(self):
+        redis = FakeRedisClient()
+        first = redis.xadd("stream", {"n": "1"})
+        redis.xadd("stream", {"n": "2"})
+        assert [entry_id for entry_id, _ in redis.xrange("stream", count=1)] == [first]
+        assert len(redis.xrange("stream", "-", "+")) == 2
+
+    def test_xrange_bounds_are_not_supported(self):
+        redis = FakeRedisClient()
+        entry_id = redis.xadd("stream", {"n": "1"})
+        with pytest.raises(NotImplementedError):
+            redis.xrange("stream", min=entry_id)
+        with pytest.raises(NotImplementedError):
+            redis.xrange("stream", max=entry_id)
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import threading
+
+import leader
+import models
+import controller
+import redis_api
+import write_behind
+from tests.test_controller import add_vehicle
+from tests.utils import FakeRedisClient, db_session
+
+
+def get_vehicle(session, plate):
+    return session.query(models.Vehicle).filter_by(plate=plate).one()
+
+
+class TestWriteBehind:
+    def test_disabled(self, mocker):
+        mocker.patch("write_behind.queue", None)
+        assert not write_behind.enabled()
+        assert write_behind.status() == models.WriteBehindStatusResponse(
+            enabled=False, pending=0
+        )
+
+    def test_remove_vehicle_is_written_on_flush(self, mocker, db_session):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        mocker.patch("write_behind.queue", write_behind.InProcessQueue())
+        add_vehicle(db_session, redis_api.redis, "A")
+        controller.remove_vehicle("A", db_session)
+        db_session.rollback()
+        assert get_vehicle(db_session, "A").parked
+        status = write_behind.status()
+        assert status.pending == 1
+        assert status.lag_seconds >= 0
+
+        assert write_behind.flush(db_session) == 1
+        db_session.expire_all()
+        assert not get_vehicle(db_session, "A").parked
+        assert write_behind.status().pending == 0
+        assert write_behind.status().lag_seconds is None
+
+    def test_flush_keeps_last_change(self, mocker, db_session):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        mocker.patch("write_behind.queue", write_behind.InProcessQueue())
+        mocker.patch("write_behind.params.WRITE_BEHIND_BATCH_SIZE", 2)
+        vehicle = add_vehicle(
+            db_session, redis_api.redis, "A", current_charge=0, total_charge=100
+        )
+        for current_charge in (10, 20, 30):
+            vehicle.current_charge = current_charge
+            write_behind.enqueue([vehicle])
+        db_session.rollback()
+
+        assert write_behind.flush(db_session) == 3
+        db_session.expire_all()
+        assert get_vehicle(db_session, "A").current_charge == 30
+
+    def test_update_and_retrieve_ready_is_queued(self, mocker, db_session):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        mocker.patch("write_behind.queue", write_behind.InProcessQueue())
+        add_vehicle(db_session, redis_api.redis, "A")
+        add_vehicle(db_session, redis_api.redis, "B")
+        controller.update_and_retrieve_ready(db_session)
+        assert write_behind.status().pending == 1
+        assert len(write_behind.queue.peek(10)[0][1]) == 2
+
+    def test_redis_stream_queue(self, mocker, db_session):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        mocker.patch("write_behind.queue", write_behind.RedisStreamQueue())
+        add_vehicle(db_session, redis_api.redis, "A")
+        controller.remove_vehicle("A", db_session)
+        db_session.rollback()
+        assert redis_api.retrieve_all() == []
+        assert write_behind.status().pending == 1
+
+        assert write_behind.flush(db_session) == 1
+        db_session.expire_all()
+        assert not get_vehicle(db_session, "A").parked
+        assert write_behind.status().pending == 0
+
+    def test_only_lease_holder_flushes(self, mocker, db_session):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        mocker.patch("write_behind.queue", write_behind.RedisStreamQueue())
+        add_vehicle(db_session, redis_api.redis, "A")
+        controller.remove_vehicle("A", db_session)
+        db_session.rollback()
+        other_worker = leader.LeaderLease("write-behind", 1000)
+        assert other_worker.acquire()
+        assert write_behind.flush(db_session) == 0
+        assert write_behind.status().pending == 1
+
+        other_worker.release()
+        assert write_behind.flush(db_session) == 1
+        assert not other_worker.acquire()
+
+    def test_flush_is_fenced_by_lease(self, mocker, db_session):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        mocker.patch("write_behind.queue", write_behind.RedisStreamQueue())
+        add_vehicle(db_session, redis_api.redis, "A")
+        controller.remove_vehicle("A", db_session)
+        db_session.rollback()
+        # the lease is lost between the UPDATE and its commit
+        mocker.patch.object(write_behind.lease, "acquire", side_effect=[True, False])
+        assert write_behind.flush(db_session) == 0
+        assert write_behind.status().pending == 1
+        db_session.expire_all()
+        assert get_vehicle(db_session, "A").parked
+
+    def test_drain_waits_for_lease_holder(self, mocker, db_session, caplog):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        mocker.patch("write_behind.queue", write_behind.RedisStreamQueue())
+        mocker.patch("write_behind.params.WRITE_BEHIND_INTERVAL", 0.01)
+        add_vehicle(db_session, redis_api.redis, "A")
+        controller.remove_vehicle("A", db_session)
+        db_session.rollback()
+        assert leader.LeaderLease("write-behind", 1000).acquire()
+        with caplog.at_level(logging.WARNING):
+            asyncio.run(write_behind.drain(db_session))
+        assert write_behind.status().pending == 1
+        assert "not flushed in time" in caplog.text
+
+    def test_drain(self, mocker, db_session):
+        mocker.patch("redis_api.redis", FakeRedisClient())
+        mocker.patch("write_behind.queue", write_behind.RedisStreamQueue())
+        add_vehicle(db_session, redis_api.redis, "A")
+        controller.remove_vehicle("A", db_session)
+        db_session.rollback()
+        asyncio.run(write_behind.drain(db_session))
+        assert write_behind.status().pending == 0
+
+    def test_flush_is_serialized(self, mocker, db_session):
+        mocker.patch("write_behind.queue", write_behind.InProcessQueue())
+        with write_behind._flush_lock:
+            flusher = threading.Thread(target=write_behind.flush, args=(db_session,))
+            flusher.start()
+            flusher.join(0.1)
+            assert flusher.is_alive()
+        flusher.join(1)
+        assert not flusher.is_alive()
@@ -1,36 +1,320 @@
+import fnmatch
+import functools
+import itertools
+import math
+import time
+
 import pytest
+from redis.exceptions import WatchError
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql.psycopg2 import EXECUTEMANY_VALUES_PLUS_BATCH
+from sqlalchemy.orm import sessionmaker
 
+import database
 import models
-from database import engine, SessionLocal
+from database import engine
 
 
 class FakeRedisClient:
+    """
+    In-memory replacement of redis.Redis for tests.
+    Supports strings, sorted sets, streams, expiration and pipelines with WATCH.
+    round_trips counts the requests a real client would send to the server.
+    """
+
     def __init__(self):
         self.d = {}
+        self.expires = {}
+        self.round_trips = 0
+        self._stream_ids = itertools.count()
+
+    def __getattr__(self, name):
+        command = getattr(type(self), f"_{name}", None)
+        if command is None:
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            self.round_trips += 1
+            return command(self, *args, **kwargs)
+
+        return call
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def _purge(self, key):
+        key = _key(key)
+        if key in self.expires and self.expires[key] <= time.monotonic():
+            del self.expires[key]
+            self.d.pop(key, None)
+        return key
 
-    def get(self, key):
-        if key in self.d:
-            return self.d[key]
-        raise KeyError()
+    def _snapshot(self, key):
+        key = self._purge(key)
+        return self.d.get(key), self.expires.get(key)
 
-    def set(self, key, value):
+    def _pexpire(self, key, milliseconds):
+        key = self._purge(key)
+        if key not in self.d:
+            return False
+        self.expires[key] = time.monotonic() + milliseconds / 1000
+        return True
+
+    # strings
+
+    def _get(self, key):
+        value = self.d.get(self._purge(key))
+        if value is not None and not isinstance(value, bytes):
+            raise TypeError("WRONGTYPE")
+        return value
+
+    def _mget(self, keys, *args):
+        keys = [keys] if isinstance(keys, (str, bytes)) else list(keys)
+        return [self._get(key) for key in keys + list(args)]
+
+    def _set(self, key, value, nx=False, px=None):
+        key = self._purge(key)
+        if nx and key in self.d:
+            return None
         self.d[key] = str(value).encode()
+        self.expires.pop(key, None)
+        if px is not None:
+            self._pexpire(key, px)
+        return True
 
-    def delete(self, key):
-        del self.d[key]
+    def _delete(self, *keys):
+        deleted = 0
+        for key in map(self._purge, keys):
+            self.expires.pop(key, None)
+            deleted += self.d.pop(key, None) is not None
+        return deleted
 
-    def exists(self, key):
-        return key in self.d
+    def _exists(self, *keys):
+        return sum(self._purge(key) in self.d for key in keys)
 
-    def keys(self):
-        return list(key.encode() for key in self.d.keys())
+    def _keys(self, pattern="*"):
+        for key in list(self.d):
+            self._purge(key)
+        return [key.encode() for key in self.d if fnmatch.fnmatchcase(key, pattern)]
 
+    # sorted sets
 
-@pytest.fixture()
-def db_session():
+    def _zadd(self, key, mapping):
+        zset = self.d.setdefault(_key(key), {})
+        added = sum(_key(member) not in zset for member in mapping)
+        zset.update({_key(member): float(score) for member, score in mapping.items()})
+        return added
+
+    def _zrem(self, key, *members):
+        zset = self.d.get(_key(key), {})
+        removed = sum(zset.pop(_key(member), None) is not None for member in members)
+        if not zset:
+            # Redis deletes the key with its last member
+            self.d.pop(_key(key), None)
+        return removed
+
+    def _zscore(self, key, member):
+        return self.d.get(_key(key), {}).get(_key(member))
+
+    def _zcard(self, key):
+        return len(self.d.get(_key(key), {}))
+
+    def _zrange(self, key, start, end, withscores=False):
+        items = self._zitems(key)
+        # negative indexes count from the end, the end index is inclusive
+        start = max(0, start + len(items) if start < 0 else start)
+        end = end + len(items) if end < 0 else end
+        return _zresult(items[start : end + 1] if end >= 0 else [], withscores)
+
+    def _zrangebyscore(self, key, min, max, withscores=False):
+        low, low_exclusive = _score_bound(min)
+        high, high_exclusive = _score_bound(max)
+        return _zresult(
+            [
+                (member, score)
+                for member, score in self._zitems(key)
+                if (low < score if low_exclusive else low <= score)
+                and (score < high if high_exclusive else score <= high)
+            ],
+            withscores,
+        )
+
+    def _zitems(self, key):
+        # ordered by score, then by member like in Redis
+        return sorted(
+            self.d.get(_key(key), {}).items(), key=lambda item: (item[1], item[0])
+        )
+
+    # streams
+
+    def _xadd(self, key, fields):
+        entry_id = f"{int(time.time() * 1000)}-{next(self._stream_ids)}".encode()
+        self.d.setdefault(_key(key), []).append(
+            (entry_id, {_key(k).encode(): str(v).encode() for k, v in fields.items()})
+        )
+        return entry_id
+
+    def _xrange(self, key, min="-", max="+", count=None):
+        if (min, max) != ("-", "+"):
+            raise NotImplementedError("only the - + range is supported")
+        entries = self.d.get(_key(key), [])
+        return list(entries[:count] if count is not None else entries)
+
+    def _xdel(self, key, *entry_ids):
+        entry_ids = {_key(entry_id) for entry_id in entry_ids}
+        entries = self.d.get(_key(key), [])
+        kept = [entry for entry in entries if entry[0].decode() not in entry_ids]
+        self.d[_key(key)] = kept
+        return len(entries) - len(kept)
+
+    def _xlen(self, key):
+        return len(self.d.get(_key(key), []))
+
+
+class FakePipeline:
+    """
+    Buffers the commands of a FakeRedisClient and runs them in a single round trip.
+    After watch() and until multi(), commands run immediately like in redis-py;
+    execute() raises WatchError if a watched key changed in the meantime.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+        self.watched = {}
+        self.immediate = False
+
+    def __getattr__(self, name):
+        command = getattr(type(self.client), f"_{name}", None)
+        if command is None:
+            raise AttributeError(name)
+
+        def queue(*args, **kwargs):
+            if self.immediate:
+                self.client.round_trips += 1
+                return command(self.client, *args, **kwargs)
+            self.commands.append((command, args, kwargs))
+            return self
+
+        return queue
+
+    def watch(self, *keys):
+        self.client.round_trips += 1
+        self.watched = {key: self.client._snapshot(key) for key in keys}
+        self.immediate = True
+
+    def multi(self):
+        self.immediate = False
+
+    def reset(self):
+        self.commands = []
+        self.watched = {}
+        self.immediate = False
+
+    def execute(self):
+        self.client.round_trips += 1
+        changed = any(
+            self.client._snapshot(key) != snapshot
+            for key, snapshot in self.watched.items()
+        )
+        commands = self.commands
+        self.reset()
+        if changed:
+            raise WatchError()
+        return [
+            command(self.client, *args, **kwargs) for command, args, kwargs in commands
+        ]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.reset()
+
+
+def _key(key):
+    return key.decode() if isinstance(key, bytes) else str(key)
+
+
+def _score_bound(bound):
+    """
+    :return: score, whether the bound is exclusive ("(1" in Redis)
+    """
+    if isinstance(bound, str) and bound.startswith("("):
+        return float(bound[1:]), True
+    return float(bound), False
+
+
+def _zresult(items, withscores):
+    if withscores:
+        return [(member.encode(), score) for member, score in items]
+    return [member.encode() for member, _ in items]
+
+
+class QueryCounter:
+    """
+    Context manager that records the SQL statements sent to the database.
+    count is the number of round trips: an executemany sends its parameter sets one by one,
+    or in pages of executemany_batch_page_size with executemany_mode="values_plus_batch".
+    Savepoints are not counted by default, as the db_session fixture adds them to every commit.
+    """
+
+    def __init__(self, savepoints=False):
+        self.statements = []
+        self.round_trips = 0
+        self.savepoints = savepoints
+
+    def __enter__(self):
+        event.listen(engine, "before_cursor_execute", self._record)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(engine, "before_cursor_execute", self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        if self.savepoints or not statement.lstrip().upper().startswith(
+            ("SAVEPOINT", "RELEASE SAVEPOINT", "ROLLBACK TO SAVEPOINT")
+        ):
+            self.statements.append(statement)
+            self.round_trips += _round_trips(conn.dialect, parameters, executemany)
+
+    @property
+    def count(self):
+        return self.round_trips
+
+
+def _round_trips(dialect, parameters, executemany):
+    if not executemany:
+        return 1
+    if getattr(dialect, "executemany_mode", None) is EXECUTEMANY_VALUES_PLUS_BATCH:
+        return math.ceil(len(parameters) / dialect.executemany_batch_page_size)
+    return len(parameters)
+
+
+@functools.cache
+def _create_tables():
     models.Base.metadata.drop_all(bind=engine)
     models.Base.metadata.create_all(engine)
-    session = SessionLocal()
+
+
+@pytest.fixture()
+def db_session(monkeypatch):
+    """
+    Session bound to a transaction that is rolled back after the test.
+    Sessions opened by the application share the same transaction, their commits only
+    release a savepoint.
+    """
+    _create_tables()
+    connection = engine.connect()
+    transaction = connection.begin()
+    session_factory = sessionmaker(
+        bind=connection,
+        autoflush=False,
+        join_transaction_mode="create_savepoint",
+    )
+    monkeypatch.setattr(database, "SessionLocal", session_factory)
+    session = session_factory()
     yield session
     session.close()
-    models.Base.metadata.drop_all(bind=engine)
+    transaction.rollback()
+    connection.close()
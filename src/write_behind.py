@@ -0,0 +1,318 @@
+import abc
+import asyncio
+import collections
+import datetime
+import itertools
+import json
+import logging
+import threading
+import time
+from abc import abstractmethod
+
+import pytz
+from sqlalchemy import bindparam, update
+from sqlalchemy.orm import Session
+
+import database
+import leader
+import models
+import redis_api
+from config import params
+
+STREAM_KEY = f"{redis_api.INTERNAL_PREFIX}vehicle-updates"
+
+
+class WriteBehindQueue(abc.ABC):
+    """
+    Ordered queue of vehicle state changes waiting to be written to Postgres.
+    Each entry holds the changes of a single request.
+    Entries are removed only after they have been committed, so delivery is at-least-once.
+    """
+
+    @abstractmethod
+    def append(self, changes: list[dict]) -> None:
+        raise NotImplemented()
+
+    @abstractmethod
+    def peek(self, count: int) -> list[tuple[str, list[dict]]]:
+        """
+        :return: up to count oldest entries as a list(entry id, changes)
+        """
+        raise NotImplemented()
+
+    @abstractmethod
+    def ack(self, entry_ids: list[str]) -> None:
+        raise NotImplemented()
+
+    @abstractmethod
+    def pending(self) -> int:
+        raise NotImplemented()
+
+    @abstractmethod
+    def oldest(self) -> float | None:
+        """
+        :return: timestamp of the oldest entry or None if the queue is empty
+        """
+        raise NotImplemented()
+
+
+class InProcessQueue(WriteBehindQueue):
+    """
+    Queue kept in memory: fast, but changes are lost if the process dies before a flush.
+    """
+
+    def __init__(self):
+        self._entries = collections.deque()
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def append(self, changes: list[dict]) -> None:
+        with self._lock:
+            self._entries.append((str(next(self._ids)), time.time(), changes))
+
+    def peek(self, count: int) -> list[tuple[str, list[dict]]]:
+        with self._lock:
+            return [
+                (entry_id, changes)
+                for entry_id, _, changes in itertools.islice(self._entries, count)
+            ]
+
+    def ack(self, entry_ids: list[str]) -> None:
+        acked = set(entry_ids)
+        with self._lock:
+            # acked entries are always the oldest ones
+            while self._entries and self._entries[0][0] in acked:
+                self._entries.popleft()
+
+    def pending(self) -> int:
+        return len(self._entries)
+
+    def oldest(self) -> float | None:
+        with self._lock:
+            return self._entries[0][1] if self._entries else None
+
+
+class RedisStreamQueue(WriteBehindQueue):
+    """
+    Queue backed by a Redis stream, survives restarts of the application.
+    """
+
+    def append(self, changes: list[dict]) -> None:
+        redis_api.redis.xadd(STREAM_KEY, {"changes": json.dumps(changes)})
+
+    def peek(self, count: int) -> list[tuple[str, list[dict]]]:
+        return [
+            (_decode(entry_id), json.loads(fields[b"changes"]))
+            for entry_id, fields in redis_api.redis.xrange(
+                STREAM_KEY, "-", "+", count=count
+            )
+        ]
+
+    def ack(self, entry_ids: list[str]) -> None:
+        if entry_ids:
+            redis_api.redis.xdel(STREAM_KEY, *entry_ids)
+
+    def pending(self) -> int:
+        return redis_api.redis.xlen(STREAM_KEY)
+
+    def oldest(self) -> float | None:
+        entries = redis_api.redis.xrange(STREAM_KEY, "-", "+", count=1)
+        if not entries:
+            return None
+        # stream ids are <milliseconds>-<sequence>
+        return int(_decode(entries[0][0]).split("-")[0]) / 1000
+
+
+def _decode(value: bytes | str) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _create_queue(backend: str | None) -> WriteBehindQueue | None:
+    if not backend:
+        return None
+    if backend == "memory":
+        return InProcessQueue()
+    if backend == "redis":
+        return RedisStreamQueue()
+    raise ValueError(f"Unknown write-behind backend {backend}")
+
+
+queue = _create_queue(params.WRITE_BEHIND)
+
+# imports and the background flusher both flush, from different threads
+_flush_lock = threading.Lock()
+
+# the Redis queue is shared by all workers and flushed by the holder of the lease only
+lease = leader.LeaderLease(
+    "write-behind", max(1000, int(params.WRITE_BEHIND_INTERVAL * 3000))
+)
+
+_update_vehicle = (
+    update(models.Vehicle.__table__)
+    .where(models.Vehicle.__table__.c.plate == bindparam("b_plate"))
+    .values(
+        current_charge=bindparam("b_current_charge"),
+        start_time=bindparam("b_start_time"),
+        parked=bindparam("b_parked"),
+    )
+)
+
+
+def enabled() -> bool:
+    return queue is not None
+
+
+def enqueue(vehicles: list[models.Vehicle]) -> None:
+    """
+    Queue the charge state of vehicles to be written to Postgres later
+    :param vehicles: vehicles with the state to be written
+    :return: None
+    """
+    if not vehicles:
+        return
+    queue.append(
+        [
+            {
+                "plate": vehicle.plate,
+                "current_charge": vehicle.current_charge,
+                "start_time": vehicle.start_time.timestamp(),
+                "parked": vehicle.parked,
+            }
+            for vehicle in vehicles
+        ]
+    )
+
+
+def flush(session: Session) -> int:
+    """
+    Write all pending changes to Postgres, in batches of WRITE_BEHIND_BATCH_SIZE entries.
+    Only the last change of each vehicle in a batch is written.
+    Flushes are serialized, so that a batch is never written after a newer one: within the
+    process with a lock, between workers sharing the Redis queue with the leader lease,
+    which is renewed before each batch.
+    :param session: db session
+    :return: number of flushed entries
+    """
+    if queue is None:
+        return 0
+    with _flush_lock:
+        return _flush_batches(session)
+
+
+def _flush_batches(session: Session) -> int:
+    flushed = 0
+    while _holds_lease() and (entries := queue.peek(params.WRITE_BEHIND_BATCH_SIZE)):
+        latest = {}
+        for _, changes in entries:
+            for change in changes:
+                latest[change["plate"]] = change
+        session.execute(
+            _update_vehicle,
+            [
+                {
+                    "b_plate": change["plate"],
+                    "b_current_charge": change["current_charge"],
+                    "b_start_time": datetime.datetime.fromtimestamp(
+                        change["start_time"], tz=pytz.utc
+                    ),
+                    "b_parked": change["parked"],
+                }
+                for change in latest.values()
+            ],
+        )
+        if not _holds_lease():
+            # the lease expired during the batch, another worker may be flushing newer changes
+            session.rollback()
+            break
+        session.commit()
+        queue.ack([entry_id for entry_id, _ in entries])
+        flushed += len(entries)
+    return flushed
+
+
+def _holds_lease() -> bool:
+    return not isinstance(queue, RedisStreamQueue) or lease.acquire()
+
+
+async def drain(session: Session) -> None:
+    """
+    Write to Postgres the changes queued before the call.
+    If another worker holds the lease of the Redis queue, wait for it to flush them,
+    up to 10 flush intervals.
+    :param session: db session
+    :return: None
+    """
+    if queue is None:
+        return
+    started = time.time()
+    deadline = time.monotonic() + 10 * params.WRITE_BEHIND_INTERVAL
+    while True:
+        await asyncio.to_thread(flush, session)
+        # ids of the Redis queue hold the time of the Redis server, assumed in sync
+        oldest = queue.oldest()
+        if oldest is None or oldest > started:
+            return
+        if time.monotonic() >= deadline:
+            logging.warning("Write-behind queue was not flushed in time, going on")
+            return
+        await asyncio.sleep(params.WRITE_BEHIND_INTERVAL / 10)
+
+
+def status() -> models.WriteBehindStatusResponse:
+    """
+    :return: number of pending entries and age in seconds of the oldest one
+    """
+    if queue is None:
+        return models.WriteBehindStatusResponse(enabled=False, pending=0)
+    oldest = queue.oldest()
+    return models.WriteBehindStatusResponse(
+        enabled=True,
+        pending=queue.pending(),
+        lag_seconds=time.time() - oldest if oldest is not None else None,
+    )
+
+
+def _flush_pending() -> None:
+    lag = status().lag_seconds
+    session = database.SessionLocal()
+    try:
+        flushed = flush(session)
+    finally:
+        session.close()
+    if flushed:
+        logging.info(f"Flushed {flushed} write-behind entries, lag was {lag or 0:.3f}s")
+
+
+async def _flush_safely() -> None:
+    try:
+        await asyncio.to_thread(_flush_pending)
+    except Exception as ex:
+        logging.error(f"Could not flush write-behind entries due to: {ex}")
+
+
+async def run_flusher() -> None:
+    """
+    Flush pending changes every WRITE_BEHIND_INTERVAL seconds, until cancelled.
+    Every worker runs it, but only the holder of the lease flushes the Redis queue.
+    A final flush is done on cancellation, then the lease is released.
+    """
+    if isinstance(queue, InProcessQueue) and params.WORKERS > 1:
+        logging.warning(
+            "WRITE_BEHIND=memory keeps a queue per worker, changes to the same vehicle "
+            "made by different workers may be written out of order: use WRITE_BEHIND=redis"
+        )
+    try:
+        while True:
+            await asyncio.sleep(params.WRITE_BEHIND_INTERVAL)
+            await _flush_safely()
+    finally:
+        await _flush_safely()
+        if isinstance(queue, RedisStreamQueue):
+            await _release_lease()
+
+
+async def _release_lease() -> None:
+    try:
+        await asyncio.to_thread(lease.release)
+    except Exception as ex:
+        logging.error(f"Could not release {lease.key} due to: {ex}")